@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from map_render import ANIMATION_FORMATS, DEFAULT_SETTINGS, DEFAULT_SHAPEFILE, EXPORT_FORMATS, GRID_SIZES, GRID_STATISTICS, JOIN_AGGREGATES, SVG_DECIMALS, export_animation, export_map, load_boundaries, load_plot_data, plot_columns
+from render_trace import RenderTrace
+
+# Headless renderer: maps many data files and columns in parallel without importing tkinter.
+#
+# A job spec is a JSON file holding either a list of jobs or {"defaults": {...}, "jobs": [...]}.
+# Each job takes the render settings used by the GUI (plot_type, country_code, shapefile_code,
+# variable, color_scheme, aggregate, lat, lon, dot_color, dot_size, size_column, fill_countries, fill_color)
+# plus "datafile", "output", and optionally "header", "shapefile", "rasterize" and "decimals"
+# (see export_map). A job may list "variables" instead of "variable" to render one map per column.
+# A job with "frame_columns" (choropleth) or "time_column" (point) renders an animation instead,
+# as a .gif, .mp4 or numbered .svg files, at "fps" frames per second (see export_animation).
+
+JOB_KEYS = {'datafile', 'output', 'header', 'shapefile', 'variables', 'rasterize', 'decimals', 'fps', 'frame_workers'}
+
+def expand_jobs(spec, defaults=None, output_dir='.', output_format='svg'):
+    if isinstance(spec, dict):
+        defaults = {**(defaults or {}), **spec.get('defaults', {})}
+        spec = spec['jobs']
+    jobs = []
+    for entry in spec:
+        entry = {**(defaults or {}), **entry}
+        unknown = set(entry) - set(DEFAULT_SETTINGS) - JOB_KEYS
+        if unknown:
+            raise ValueError(f"Unknown job keys: {', '.join(sorted(unknown))}")
+        datafiles = entry['datafile'] if isinstance(entry['datafile'], list) else [entry['datafile']]
+        variables = entry.get('variables') or [entry.get('variable')]
+        for datafile in datafiles:
+            for variable in variables:
+                job = {k: v for k, v in entry.items() if k != 'variables'}
+                job['datafile'] = datafile
+                job['variable'] = variable
+                if not entry.get('output') or len(datafiles) > 1 or len(variables) > 1:
+                    job['output'] = output_name(datafile, variable, output_dir, output_format)
+                    job['named'] = True
+                jobs.append(job)
+
+    # Data files of the same name in different directories keep their directory in the map name
+    counts = Counter(job['output'] for job in jobs)
+    for job in jobs:
+        if job.pop('named', False) and counts[job['output']] > 1:
+            job['output'] = output_name(job['datafile'], job['variable'], output_dir, output_format, with_directory=True)
+    duplicates = sorted(output for output, count in Counter(job['output'] for job in jobs).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"Several jobs write {', '.join(duplicates)}")
+    return jobs
+
+
+def output_name(datafile, variable, output_dir, output_format, with_directory=False):
+    stem = os.path.splitext(os.path.relpath(datafile) if with_directory else os.path.basename(datafile))[0]
+    stem = stem.replace(os.sep, '_').replace('/', '_').replace('..', 'up')
+    name = f"{stem}_{variable}" if variable is not None else stem
+    return os.path.join(output_dir, f"{name}.{output_format}")
+
+
+def job_settings(job):
+    return {key: job.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+
+
+def add_preload_columns(jobs):
+    # Every job on the same file and plot type reads the union of their columns in one pass,
+    # so a worker loads each file once however many variables it renders from it
+    union = {}
+    for job in jobs:
+        key = (job['datafile'], job.get('plot_type'))
+        union.setdefault(key, {}).update(dict.fromkeys(plot_columns(job_settings(job))[0]))
+    for job in jobs:
+        job['preload'] = list(union[(job['datafile'], job.get('plot_type'))])
+
+
+def add_trace_paths(jobs, trace_dir, profile):
+    # One JSON trace (and optionally one cProfile dump) per output, named after it; outputs of
+    # the same name in different directories keep their directory in the trace name
+    counts = Counter(os.path.basename(job['output']) for job in jobs)
+    for job in jobs:
+        name = os.path.basename(job['output'])
+        if counts[name] > 1:
+            name = os.path.relpath(job['output']).replace(os.sep, '_').replace('/', '_').replace('..', 'up')
+        name = os.path.join(trace_dir, name)
+        job['trace'] = name + '.trace.json'
+        job['profile'] = name + '.prof' if profile else None
+
+
+def render_job(job):
+    # Runs in a pool worker: boundaries and data files are loaded once per process and reused
+    settings = job_settings(job)
+    trace = RenderTrace('batch', path=job.get('trace'), profile_path=job.get('profile'),
+                        track_memory=job.get('trace_memory', False), datafile=job['datafile'], output=job['output'], settings=settings)
+    with trace:
+        geo_data = load_boundaries(job.get('shapefile') or DEFAULT_SHAPEFILE)
+        data = load_plot_data(job['datafile'], job.get('header', True), settings, preload=job['preload'])
+        os.makedirs(os.path.dirname(job['output']) or '.', exist_ok=True)
+        if settings['frame_columns'] or settings['time_column'] is not None:
+            path = export_animation(geo_data, data, settings, job['output'], workers=job.get('frame_workers', 1),
+                                    fps=job.get('fps', 2))
+        else:
+            path = export_map(geo_data, data, settings, job['output'], rasterize=job.get('rasterize', 'auto'),
+                              decimals=job.get('decimals', SVG_DECIMALS))
+    return path, trace.summary()
+
+
+def preload_worker(shapefiles):
+    for shapefile in shapefiles:
+        load_boundaries(shapefile)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render maps without the GUI. Options act as defaults for every job in the spec.")
+    parser.add_argument('spec', nargs='?', help="JSON job spec; omit to build a single job from the options")
+    parser.add_argument('--datafile', nargs='+', help="data file(s) to map")
+    parser.add_argument('--plot-type', choices=['choropleth', 'point', 'grid'])
+    parser.add_argument('--country-code', help="datafile code column")
+    parser.add_argument('--shapefile-code', help="shapefile code column")
+    parser.add_argument('--variables', nargs='+', help="variable column(s), one map each")
+    parser.add_argument('--lat', help="latitude column")
+    parser.add_argument('--lon', help="longitude column")
+    parser.add_argument('--color-scheme', help="matplotlib colormap name")
+    parser.add_argument('--grid-size', choices=list(GRID_SIZES), help="EEA reference grid cell size")
+    parser.add_argument('--grid-statistic', choices=list(GRID_STATISTICS))
+    parser.add_argument('--grid-column', help="column summed or averaged per grid cell")
+    parser.add_argument('--aggregate', choices=list(JOIN_AGGREGATES), help="combine data rows sharing a code (default mean)")
+    parser.add_argument('--frame-columns', nargs='+', help="animate a choropleth, one frame per column")
+    parser.add_argument('--time-column', help="animate a point plot, one frame per value of this column")
+    parser.add_argument('--fps', type=float, help="animation frames per second (default 2)")
+    parser.add_argument('--no-header', action='store_true', help="first row is data, not a header")
+    parser.add_argument('--shapefile', help=f"boundary shapefile (default {DEFAULT_SHAPEFILE})")
+    parser.add_argument('--output', help="output path for a single map")
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--format', default='svg', choices=list(dict.fromkeys([*EXPORT_FORMATS, *ANIMATION_FORMATS])),
+                        help="gif and mp4 are for animations; an animated svg is one file per frame")
+    parser.add_argument('--rasterize', choices=['auto', 'data', 'none'],
+                        help="embed the data layer as an image in vector output: when dense (auto, default), always, or never")
+    parser.add_argument('--decimals', type=int, help=f"decimals kept in SVG coordinates (default {SVG_DECIMALS})")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--trace', metavar='DIR', help="write a JSON stage trace per map to DIR")
+    parser.add_argument('--profile', action='store_true', help="also write a cProfile dump per map to the trace DIR")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="record peak allocated memory per stage; slows drawing and saving")
+    args = parser.parse_args(argv)
+
+    options = {
+        'plot_type': args.plot_type,
+        'country_code': args.country_code,
+        'shapefile_code': args.shapefile_code,
+        'variables': args.variables,
+        'lat': args.lat,
+        'lon': args.lon,
+        'color_scheme': args.color_scheme,
+        'grid_size': args.grid_size,
+        'grid_statistic': args.grid_statistic,
+        'grid_column': args.grid_column,
+        'aggregate': args.aggregate,
+        'frame_columns': args.frame_columns,
+        'time_column': args.time_column,
+        'fps': args.fps,
+        'header': False if args.no_header else None,
+        'shapefile': args.shapefile,
+        'output': args.output,
+        'rasterize': args.rasterize,
+        'decimals': args.decimals,
+    }
+    options = {k: v for k, v in options.items() if v is not None}
+    if args.spec:
+        with open(args.spec) as f:
+            spec = json.load(f)
+    elif args.datafile:
+        spec = [{'datafile': args.datafile}]
+    else:
+        parser.error("either a job spec or --datafile is required")
+    try:
+        jobs = expand_jobs(spec, defaults=options, output_dir=args.output_dir, output_format=args.format)
+    except ValueError as e:
+        parser.error(str(e))
+    if not jobs:
+        return 0
+    add_preload_columns(jobs)
+    if args.profile and not args.trace:
+        parser.error("--profile needs --trace DIR")
+    if args.trace:
+        add_trace_paths(jobs, args.trace, args.profile)
+    for job in jobs:
+        job['trace_memory'] = args.trace_memory
+    if len(jobs) == 1:
+        jobs[0].setdefault('frame_workers', args.workers)  # a lone animation spreads its frames instead
+
+    failures = 0
+    shapefiles = sorted({job.get('shapefile') or DEFAULT_SHAPEFILE for job in jobs})
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(jobs)), initializer=preload_worker,
+                             initargs=(shapefiles,)) as pool:
+        futures = {pool.submit(render_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                path, summary = future.result()
+                print(f"Map saved as {path} in {summary}")
+            except Exception as e:
+                failures += 1
+                print(f"Failed {job['datafile']} / {job.get('variable')}: {e}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
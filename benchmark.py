@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from map_render import DEFAULT_SETTINGS, DEFAULT_SHAPEFILE, build_figure, clear_caches, export_map, load_boundaries, load_plot_data, read_columns
+from render_trace import RenderTrace
+
+# Headless benchmark of the GUI's hot paths on synthetic data, run with Agg and no display.
+#
+# Each case times the steps behind Application.preload_shapefile (cold and with the disk cache),
+# load_file, plot (load, build and the off-screen draw) and save_to_disk (SVG export, with its
+# size). Results are written as JSON; --compare flags cases that got slower or bigger than a
+# previous results file and exits non-zero.
+#
+#     python benchmark.py --sizes 1000 100000 1000000 --output bench_data/before.json
+#     python benchmark.py --sizes 1000 100000 1000000 --compare bench_data/before.json
+
+BENCH_EXTENT = (-10, 35, 30, 70)  # lon/lat box the synthetic points and shapes are spread over
+SHAPE_COMPLEXITY = {'simple': (100, 50), 'medium': (500, 500), 'complex': (1000, 5000)}  # features, vertices per feature
+COUNTRY_CODE_COLUMNS = ('ADM0_A3', 'ISO_A3')  # tried in order on the bundled countries
+METRICS = ('preload_cold', 'preload_warm', 'load_file', 'plot', 'save', 'svg_bytes')
+
+
+def points_file(workdir, rows, seed=0):
+    path = os.path.join(workdir, f"points_{rows}.csv")
+    if not os.path.exists(path):
+        rng = np.random.default_rng(seed)
+        frame = pd.DataFrame({
+            'lat': rng.uniform(BENCH_EXTENT[1], BENCH_EXTENT[3], rows).round(5),
+            'lon': rng.uniform(BENCH_EXTENT[0], BENCH_EXTENT[2], rows).round(5),
+            'value': rng.gamma(2.0, 10.0, rows).round(3),
+            'size': rng.integers(1, 20, rows),
+        })
+        write_csv(frame, path)
+    return path
+
+
+def write_csv(frame, path):
+    try:
+        import pyarrow
+        import pyarrow.csv
+        pyarrow.csv.write_csv(pyarrow.Table.from_pandas(frame, preserve_index=False), path + '.part')
+    except ImportError:
+        frame.to_csv(path + '.part', index=False)
+    os.replace(path + '.part', path)
+
+
+def shapes_file(workdir, complexity, seed=0):
+    # Star-shaped polygons on a lon/lat lattice: always valid, and with random radii their
+    # vertices survive simplification, so the vertex count is what the renderer really handles
+    path = os.path.join(workdir, f"shapes_{complexity}.shp")
+    if not os.path.exists(path):
+        features, vertices = SHAPE_COMPLEXITY[complexity]
+        rng = np.random.default_rng(seed)
+        columns = int(np.ceil(np.sqrt(features * 1.5)))
+        rows = int(np.ceil(features / columns))
+        step_x = (BENCH_EXTENT[2] - BENCH_EXTENT[0]) / columns
+        step_y = (BENCH_EXTENT[3] - BENCH_EXTENT[1]) / rows
+        angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+        polygons = []
+        for i in range(features):
+            cx = BENCH_EXTENT[0] + (i % columns + 0.5) * step_x
+            cy = BENCH_EXTENT[1] + (i // columns + 0.5) * step_y
+            radius = 0.45 * min(step_x, step_y) * rng.uniform(0.6, 1.0, vertices)
+            polygons.append(shapely.Polygon(np.column_stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)])))
+        codes = [f"S{i:05d}" for i in range(features)]
+        gpd.GeoDataFrame({'CODE': codes}, geometry=polygons, crs=4326).to_file(path)
+    return path
+
+
+def table_file(workdir, name, codes, seed=0):
+    # One row per code plus 10% codes the shapefile does not know, as real tables have
+    path = os.path.join(workdir, f"table_{name}.csv")
+    if not os.path.exists(path):
+        rng = np.random.default_rng(seed)
+        codes = list(codes) + [f"X{i:04d}" for i in range(max(1, len(codes) // 10))]
+        write_csv(pd.DataFrame({'code': codes, 'value': rng.gamma(2.0, 10.0, len(codes)).round(3)}), path)
+    return path
+
+
+def build_cases(workdir, sizes, shapes, fill_max):
+    def case(name, shapefile, datafile, **settings):
+        return {'name': name, 'shapefile': shapefile, 'datafile': datafile, 'settings': {**DEFAULT_SETTINGS, **settings}}
+
+    # The bundled countries when they are there, otherwise the medium synthetic shapes stand in
+    if os.path.exists(DEFAULT_SHAPEFILE):
+        countries = DEFAULT_SHAPEFILE
+        frame = gpd.read_file(countries, ignore_geometry=True)
+        code_column = next(column for column in (*COUNTRY_CODE_COLUMNS, frame.columns[0]) if column in frame.columns)
+    else:
+        countries = shapes_file(workdir, 'medium')
+        frame = gpd.read_file(countries, ignore_geometry=True)
+        code_column = 'CODE'
+    table = table_file(workdir, 'countries', frame[code_column].dropna().unique())
+
+    cases = [case('choropleth-countries', countries, table, country_code='code', shapefile_code=code_column, variable='value')]
+    for rows in sizes:
+        points = points_file(workdir, rows)
+        cases.append(case(f'point-{rows}', countries, points, plot_type='point', lat='lat', lon='lon'))
+        cases.append(case(f'point-size-{rows}', countries, points, plot_type='point', lat='lat', lon='lon', size_column='size'))
+        if rows <= fill_max:
+            cases.append(case(f'point-fill-{rows}', countries, points, plot_type='point', lat='lat', lon='lon', fill_countries=True))
+        cases.append(case(f'grid-{rows}', countries, points, plot_type='grid', lat='lat', lon='lon',
+                          grid_statistic='mean', grid_column='value'))
+    for complexity in shapes:
+        shapefile = shapes_file(workdir, complexity)
+        codes = gpd.read_file(shapefile, ignore_geometry=True)['CODE']
+        cases.append(case(f'shapefile-{complexity}', shapefile, table_file(workdir, complexity, codes),
+                          country_code='code', shapefile_code='CODE', variable='value'))
+    return cases
+
+
+def timed(label, function):
+    with RenderTrace(label) as trace:
+        result = function()
+    return result, trace
+
+
+def run_case(case, workdir, repeat):
+    output = os.path.join(workdir, 'out', case['name'] + '.svg')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    settings = case['settings']
+    best = {}
+    stages = {}
+    for _ in range(repeat):
+        # Every repeat starts like a fresh application: empty memory caches, no disk cache
+        clear_caches()
+        shutil.rmtree(os.path.join(workdir, 'cache'), ignore_errors=True)
+        runs = {}
+        geo_data, runs['preload_cold'] = timed('preload_cold', lambda: load_boundaries(case['shapefile']))
+        clear_caches()
+        geo_data, runs['preload_warm'] = timed('preload_warm', lambda: load_boundaries(case['shapefile']))
+        _, runs['load_file'] = timed('load_file', lambda: read_columns(case['datafile'], True))
+
+        def plot():
+            data = load_plot_data(case['datafile'], True, settings)
+            map_figure = build_figure(geo_data, data, settings)
+            FigureCanvasAgg(map_figure.figure).draw()
+
+        _, runs['plot'] = timed('plot', plot)
+
+        def save():
+            data = load_plot_data(case['datafile'], True, settings)
+            return export_map(geo_data, data, settings, output)
+
+        _, runs['save'] = timed('save', save)
+        for metric, trace in runs.items():
+            if metric not in best or trace.seconds < best[metric]:
+                best[metric] = trace.seconds
+                stages[metric] = [{key: value for key, value in stage.items() if key != 'peak_memory'} for stage in trace.stages]
+
+    result = {metric: round(seconds, 4) for metric, seconds in best.items()}
+    result['svg_bytes'] = os.path.getsize(output)
+    result['stages'] = stages
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        'revision': git_revision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'geopandas': gpd.__version__,
+                     'shapely': shapely.__version__, 'matplotlib': matplotlib.__version__},
+    }
+
+
+def compare(results, baseline, threshold, min_seconds):
+    # (case, metric, before, after) for every metric slower or bigger than threshold times the baseline;
+    # timings under min_seconds in both runs are noise and never flagged
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in METRICS:
+            if metric not in result or metric not in before:
+                continue
+            if metric != 'svg_bytes' and max(result[metric], before[metric]) < min_seconds:
+                continue
+            if result[metric] > before[metric] * threshold:
+                regressions.append((name, metric, before[metric], result[metric]))
+    return regressions
+
+
+def print_table(results, baseline=None):
+    print(f"{'case':<28}" + ''.join(f"{metric:>14}" for metric in METRICS))
+    for name, result in results.items():
+        cells = []
+        for metric in METRICS:
+            value = result.get(metric)
+            cell = '' if value is None else (f"{value / 1024:.0f}K" if metric == 'svg_bytes' else f"{value:.3f}")
+            before = (baseline or {}).get(name, {}).get(metric)
+            if before and value is not None:
+                cell += f" {value / before - 1:+.0%}"
+            cells.append(f"{cell:>14}")
+        print(f"{name:<28}" + ''.join(cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark loading, joining, filling, rendering and exporting on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help="point file row counts (10000000 is supported but slow to generate)")
+    parser.add_argument('--shapes', nargs='+', default=['simple', 'medium'], choices=list(SHAPE_COMPLEXITY),
+                        help="synthetic user shapefiles to benchmark")
+    parser.add_argument('--fill-max', type=int, default=1000000, help="largest point file also run with country fill")
+    parser.add_argument('--cases', nargs='+', help="only run cases whose name starts with one of these")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case, the fastest is kept")
+    parser.add_argument('--workdir', default='bench_data', help="synthetic inputs, cache and exported maps")
+    parser.add_argument('--output', help="results file (default bench_results.json in the workdir)")
+    parser.add_argument('--compare', metavar='BASELINE', help="results file to compare against; exits 1 on regressions")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slowdown ratio flagged as a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.05, help="timings below this are not compared")
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    output = args.output or os.path.join(workdir, 'bench_results.json')
+    # Keep the boundary cache inside the workdir so cold runs really are cold
+    os.environ['XDG_CACHE_HOME'] = os.environ['LOCALAPPDATA'] = os.path.join(workdir, 'cache')
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    cases = build_cases(workdir, args.sizes, args.shapes, args.fill_max)
+    if args.cases:
+        cases = [case for case in cases if case['name'].startswith(tuple(args.cases))]
+    results = {}
+    for case in cases:
+        print(f"Running {case['name']}...", file=sys.stderr)
+        results[case['name']] = run_case(case, workdir, args.repeat)
+
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2, default=str)
+    print_table(results, baseline)
+    print(f"Results written to {output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for name, metric, before, after in regressions:
+            print(f"REGRESSION {name} {metric}: {before} -> {after} ({after / before - 1:+.0%})")
+        if regressions:
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
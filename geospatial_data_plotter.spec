@@ -7,7 +7,7 @@ a = Analysis(
     pathex=['.'],
     binaries=[],
     datas=[('shapefile', 'shapefile')],  # Ensure the shapefile directory is included
-    hiddenimports=['numpy', 'pandas', 'geopandas', 'matplotlib', 'cartopy', 'ttkthemes'],
+    hiddenimports=['numpy', 'pandas', 'geopandas', 'matplotlib', 'cartopy', 'ttkthemes', 'pyarrow'],
     hookspath=[],
     runtime_hooks=[],
     excludes=[],
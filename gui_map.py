@@ -1,14 +1,154 @@
+import os
+import time
+import queue
+import multiprocessing
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox, colorchooser
-import pandas as pd
-import geopandas as gpd
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use("svg")
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import cartopy.crs as ccrs
 from ttkthemes import ThemedTk
 from tkinter import ttk
+from render_trace import RenderTrace, stage, trace_dir
+
+# Only Tk is imported up front so the window shows at once; matplotlib and the map_render stack
+# (pandas, geopandas, cartopy) are imported by load_map_data on a background thread and by the
+# methods that need them, which by then is a dictionary lookup.
+
+ANIMATION_INTERVAL = 500  # ms per frame in the animation preview
+
+
+class RenderJob:
+    def __init__(self, slot, work, on_done, on_error):
+        self.slot = slot
+        self.work = work  # work(step) -> result, run on the worker thread
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = threading.Event()
+
+
+class RenderScheduler:
+    # Runs renders one at a time on a single worker thread, so two renders never share the
+    # map_render caches. Jobs go in a slot: 'preview' for the map on screen, 'export' for files.
+    # A new job supersedes the queued or running job of its own slot only and otherwise waits
+    # its turn. Results come back to the Tk thread through a queue polled with after().
+    def __init__(self, widget, on_status):
+        self.widget = widget
+        self.on_status = on_status  # on_status(message, busy)
+        self.results = queue.Queue()
+        self.lock = threading.Condition()
+        self.pending = {}  # slot -> RenderJob waiting for the worker, oldest first
+        self.running = None
+        self.polling = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                job = self.pending.pop(next(iter(self.pending)))
+                self.running = job
+            from map_render import RenderCancelled
+
+            def step(message):
+                if job.cancelled.is_set():
+                    raise RenderCancelled()
+                self.results.put((job, 'status', message))
+
+            try:
+                result = job.work(step)
+                step("Finishing")
+                self.results.put((job, 'done', result))
+            except RenderCancelled:
+                pass
+            except Exception as e:
+                self.results.put((job, 'error', e))
+            finally:
+                with self.lock:
+                    self.running = None
+
+    def jobs(self, slot=None):
+        # Queued and running jobs, of one slot or all
+        with self.lock:
+            jobs = [self.running, *self.pending.values()]
+        return [job for job in jobs if job is not None and not job.cancelled.is_set() and slot in (None, job.slot)]
+
+    def active(self, slot=None):
+        return bool(self.jobs(slot))
+
+    def submit(self, slot, work, on_done, on_error):
+        waiting = self.active()
+        for job in self.jobs(slot):
+            job.cancelled.set()
+        job = RenderJob(slot, work, on_done, on_error)
+        with self.lock:
+            self.pending.pop(slot, None)
+            self.pending[slot] = job
+            self.lock.notify()
+        self.on_status("Waiting for the current render..." if waiting and self.active() else "Rendering...", True)
+        if not self.polling:
+            self.polling = True
+            self.widget.after(50, self.poll)
+
+    def cancel(self, announce=True):
+        jobs = self.jobs()
+        for job in jobs:
+            job.cancelled.set()
+        with self.lock:
+            self.pending.clear()
+        if jobs and announce:
+            self.on_status("Cancelled", False)
+
+    def poll(self):
+        while True:
+            try:
+                job, kind, payload = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if job.cancelled.is_set():
+                continue  # superseded or cancelled
+            if kind == 'status':
+                self.on_status(payload, True)
+            elif kind == 'done':
+                self.on_status("Done", self.active())
+                job.on_done(payload)
+            else:
+                self.on_status("Failed", self.active())
+                job.on_error(payload)
+        if self.active() or not self.results.empty():
+            self.widget.after(50, self.poll)
+        else:
+            self.polling = False
+
+
+class LayerBlitter:
+    # Caches everything below a map's data layer as a bitmap after each full draw, so a
+    # restyle only redraws the data layer and whatever sits on top of it
+    def __init__(self, canvas, map_figure):
+        self.canvas = canvas
+        self.artists = map_figure.restyled_artists()
+        for artist in self.artists:
+            artist.set_animated(True)  # left out of full draws, drawn by draw_layers instead
+        self.background = None
+        self.draw_handler = canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.draw_layers()
+
+    def draw_layers(self):
+        for artist in self.artists:
+            self.canvas.figure.draw_artist(artist)
+
+    def update(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_layers()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+    def disconnect(self):
+        self.canvas.mpl_disconnect(self.draw_handler)
 
 
 class Application(ttk.Frame):
@@ -19,20 +159,81 @@ class Application(ttk.Frame):
         self.master.geometry(f"{self.master.winfo_screenwidth() - 200}x{self.master.winfo_screenheight() - 200}")
         self.master.configure(bg='#2e2e2e')
         self.pack(fill=tk.BOTH, expand=True)
-        self.preload_shapefile()  # Preload the shapefile
+        self.shapefile_path = self.geo_data = None  # set once the map data has loaded
+        self.default_shapefile = self.default_geo_data = None
         self.create_widgets_initial()
         self.fig = None
+        self.map_figure = None  # MapFigure on screen, restyled in place when only styles change
+        self.map_source = None  # (geo_data, data file, header) it was built from
+        self.blitter = None
+        self.restyle_pending = False
+        self.playback = None  # after() id while an animation preview plays
+        self.renderer = RenderScheduler(self, self.set_render_status)
         self.dot_color = '#FF0000'  # Default dot color
         self.fill_color = '#00FF00'  # Default fill color for countries
         self.color_scheme = 'viridis_r'  # Default color scheme for choropleth
-
-    def preload_shapefile(self):
-        self.shapefile_path = "_internal/ne_10m_admin_0_countries.shp"  # Path to the preloaded shapefile
-        self.geo_data = gpd.read_file(self.shapefile_path)
-        self.geo_data = self.geo_data.to_crs(epsg=3035)
-        # Ensure geometries are valid
-        self.geo_data = self.geo_data[self.geo_data.is_valid]
-        print("Shapefile loaded.")
+        self.after_idle(self.load_map_data)  # once the window is up
+
+    def load_in_background(self, message, work, done, failed):
+        # Runs work() on a thread and hands its result to done(result) or its error to failed(error)
+        # on the Tk thread; for loads that are not renders, the startup map data and uploaded shapefiles
+        results = queue.Queue()
+
+        def run():
+            try:
+                results.put(('done', work()))
+            except Exception as e:
+                results.put(('error', e))
+
+        self.status_label.configure(text=message)
+        self.progress_bar.start(10)
+        threading.Thread(target=run, daemon=True).start()
+        self.after(50, self.poll_load, results, done, failed)
+
+    def poll_load(self, results, done, failed):
+        try:
+            kind, payload = results.get_nowait()
+        except queue.Empty:
+            self.after(50, self.poll_load, results, done, failed)
+            return
+        self.progress_bar.stop()
+        if kind == 'error':
+            failed(payload)
+        else:
+            done(payload)
+
+    def load_map_data(self):
+        # Imports the plotting stack and preloads the default shapefile off the Tk thread.
+        # Not cancellable: loading a file and uploading a shapefile wait for it.
+        def work():
+            with RenderTrace('startup') as trace:
+                with stage("Import libraries"):
+                    import matplotlib
+                    matplotlib.use("svg")
+                    from map_render import DEFAULT_SHAPEFILE, load_boundaries, load_coastlines
+                geo_data = load_boundaries(DEFAULT_SHAPEFILE)
+                with stage("Load coastlines"):
+                    load_coastlines(fallback=geo_data)
+            return DEFAULT_SHAPEFILE, geo_data, trace
+
+        self.load_in_background("Loading map data...", work, self.map_data_loaded, self.map_data_failed)
+
+    def map_data_loaded(self, result):
+        self.default_shapefile, self.default_geo_data, trace = result
+        if self.geo_data is None:
+            self.shapefile_path, self.geo_data = self.default_shapefile, self.default_geo_data
+        print(f"Shapefile loaded in {trace.summary()}.")
+        self.status_label.configure(text="Map data loaded")
+        self.load_file_button.state(['!disabled'])
+        self.upload_shapefile_button.state(['!disabled'])
+
+    def map_data_failed(self, error):
+        # Another shapefile can still be uploaded; files are loaded once one is
+        self.status_label.configure(text="Map data failed to load, upload a shapefile")
+        self.upload_shapefile_button.state(['!disabled'])
+        if self.geo_data is not None:
+            self.load_file_button.state(['!disabled'])
+        messagebox.showerror("Map Data Error", str(error))
 
     def create_widgets_initial(self):
         style = ttk.Style()
@@ -61,12 +262,14 @@ class Application(ttk.Frame):
         self.choropleth_radio.pack(side=tk.LEFT, padx=5)
         self.point_radio = ttk.Radiobutton(self.plot_type_frame, text="Point Plot", variable=self.plot_type_var, value='point', command=self.update_plot_type)
         self.point_radio.pack(side=tk.LEFT, padx=5)
+        self.grid_radio = ttk.Radiobutton(self.plot_type_frame, text="Grid", variable=self.plot_type_var, value='grid', command=self.update_plot_type)
+        self.grid_radio.pack(side=tk.LEFT, padx=5)
 
-        self.load_file_button = ttk.Button(self.left_frame, text="Load file", command=self.load_file)
+        self.load_file_button = ttk.Button(self.left_frame, text="Load file", command=self.load_file, state='disabled')  # until the map data is loaded
         self.load_file_button.pack(pady=10)
         self.load_file_button.pack_forget()  # Hide initially
 
-        self.upload_shapefile_button = ttk.Button(self.left_frame, text="Upload Shapefile", command=self.upload_shapefile)
+        self.upload_shapefile_button = ttk.Button(self.left_frame, text="Upload Shapefile", command=self.upload_shapefile, state='disabled')
         self.upload_shapefile_button.pack(pady=10)
 
         self.reset_plot_frame = ttk.Frame(self.left_frame)
@@ -79,10 +282,30 @@ class Application(ttk.Frame):
 
         self.reset_plot_frame.pack(side=tk.BOTTOM, pady=10)  # Pack at bottom initially
 
+        self.status_frame = ttk.Frame(self.left_frame)
+        self.status_label = ttk.Label(self.status_frame, text="")
+        self.status_label.pack(side=tk.LEFT, padx=5)
+        self.progress_bar = ttk.Progressbar(self.status_frame, mode='indeterminate', length=120)
+        self.progress_bar.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(self.status_frame, text="Cancel", command=lambda: self.renderer.cancel(), state='disabled')
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+        self.status_frame.pack(side=tk.BOTTOM, pady=10)
+
+        # Opt-in diagnostics, written under trace_dir()
+        self.diagnostics_frame = ttk.Frame(self.left_frame)
+        self.trace_var = tk.BooleanVar()
+        self.trace_check = ttk.Checkbutton(self.diagnostics_frame, text="Write render traces", variable=self.trace_var)
+        self.trace_check.pack(side=tk.LEFT, padx=5)
+        self.profile_var = tk.BooleanVar()
+        self.profile_check = ttk.Checkbutton(self.diagnostics_frame, text="Profile next render", variable=self.profile_var)
+        self.profile_check.pack(side=tk.LEFT, padx=5)
+        self.diagnostics_frame.pack(side=tk.BOTTOM, pady=(0, 10))
+
         self.map_frame = ttk.Frame(self)
         self.map_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=10, pady=10)
 
     def create_widgets_after_file_load(self):
+        from map_render import GRID_SIZES, GRID_STATISTICS, JOIN_AGGREGATES
         self.column_selection_frame = ttk.Frame(self.left_frame)
         self.column_selection_frame.pack(pady=10)
 
@@ -117,6 +340,7 @@ class Application(ttk.Frame):
         self.color_scheme_var.set(self.color_scheme)
         # Create the color scheme dropdown
         self.color_scheme_menu = ttk.OptionMenu(self.column_selection_frame, self.color_scheme_var, 'viridis_r', 'viridis', 'plasma', 'inferno', 'magma', 'cividis')
+        self.color_scheme_var.trace_add('write', lambda *args: self.schedule_restyle())
         self.color_scheme_menu.grid(row=3, column=1, padx=5, pady=5, sticky="ew")
 
         self.lat_label = ttk.Label(self.column_selection_frame, text="Select Latitude Column:")
@@ -135,12 +359,47 @@ class Application(ttk.Frame):
         self.lon_menu = ttk.OptionMenu(self.column_selection_frame, self.lon_var, self.columns[0], *self.columns)
         self.lon_menu.grid(row=5, column=1, padx=5, pady=5, sticky="ew")
 
+        self.grid_size_label = ttk.Label(self.column_selection_frame, text="Select Grid Cell Size:")
+        self.grid_size_label.grid(row=6, column=0, padx=5, pady=5, sticky="w")
+
+        self.grid_size_var = tk.StringVar(self)
+        self.grid_size_menu = ttk.OptionMenu(self.column_selection_frame, self.grid_size_var, '10km', *GRID_SIZES)
+        self.grid_size_menu.grid(row=6, column=1, padx=5, pady=5, sticky="ew")
+
+        self.grid_statistic_label = ttk.Label(self.column_selection_frame, text="Select Grid Statistic:")
+        self.grid_statistic_label.grid(row=7, column=0, padx=5, pady=5, sticky="w")
+
+        self.grid_statistic_var = tk.StringVar(self)
+        self.grid_statistic_menu = ttk.OptionMenu(self.column_selection_frame, self.grid_statistic_var, 'count', *GRID_STATISTICS)
+        self.grid_statistic_menu.grid(row=7, column=1, padx=5, pady=5, sticky="ew")
+
+        self.grid_column_label = ttk.Label(self.column_selection_frame, text="Select Grid Value Column:")
+        self.grid_column_label.grid(row=8, column=0, padx=5, pady=5, sticky="w")
+
+        self.grid_column_var = tk.StringVar(self)
+        self.grid_column_var.set(self.columns[0])
+        self.grid_column_menu = ttk.OptionMenu(self.column_selection_frame, self.grid_column_var, self.columns[0], *self.columns)
+        self.grid_column_menu.grid(row=8, column=1, padx=5, pady=5, sticky="ew")
+
+        self.export_grid_button = ttk.Button(self.column_selection_frame, text="Export Grid Cells", command=self.export_grid)
+        self.export_grid_button.grid(row=9, column=1, padx=5, pady=5, sticky="ew")
+
+        self.aggregate_label = ttk.Label(self.column_selection_frame, text="Combine Duplicate Codes:")
+        self.aggregate_label.grid(row=10, column=0, padx=5, pady=5, sticky="w")
+
+        self.aggregate_var = tk.StringVar(self)
+        self.aggregate_menu = ttk.OptionMenu(self.column_selection_frame, self.aggregate_var, JOIN_AGGREGATES[0], *JOIN_AGGREGATES)
+        self.aggregate_menu.grid(row=10, column=1, padx=5, pady=5, sticky="ew")
+
+        self.grid_widgets = [self.grid_size_label, self.grid_size_menu, self.grid_statistic_label, self.grid_statistic_menu,
+                             self.grid_column_label, self.grid_column_menu, self.export_grid_button]
+
         self.dot_size_color_frame = ttk.Frame(self.left_frame)
         self.dot_size_color_frame.pack(pady=10)
 
         self.dot_size_label = ttk.Label(self.dot_size_color_frame, text="Dot Size:")
         self.dot_size_label.pack(side=tk.LEFT, padx=5)
-        self.dot_size_slider = ttk.Scale(self.dot_size_color_frame, from_=1, to=20, orient=tk.HORIZONTAL)
+        self.dot_size_slider = ttk.Scale(self.dot_size_color_frame, from_=1, to=20, orient=tk.HORIZONTAL, command=lambda value: self.schedule_restyle())
         self.dot_size_slider.pack(side=tk.LEFT, padx=5)
         self.dot_size_slider.set(5)  # Default dot size
 
@@ -154,6 +413,9 @@ class Application(ttk.Frame):
         
         self.color_fill_button = ttk.Button(self.fill_countries_frame, text="Select Fill Color", command=self.choose_fill_color)
         self.color_fill_button.pack(side=tk.LEFT, padx=5)
+        self.drop_outside_var = tk.BooleanVar()
+        self.drop_outside_check = ttk.Checkbutton(self.fill_countries_frame, text="Only load points inside map", variable=self.drop_outside_var)
+        self.drop_outside_check.pack(side=tk.LEFT, padx=5)
         self.fill_countries_frame.pack(pady=10)
 
         self.size_based_var = tk.BooleanVar()
@@ -163,6 +425,30 @@ class Application(ttk.Frame):
         self.size_based_column_menu = ttk.OptionMenu(self.dot_size_color_frame, self.size_based_column_var, self.columns[0], *self.columns)
         self.size_based_column_menu.pack(side=tk.LEFT, padx=5)
 
+        # Animation: one frame per selected column (choropleth) or per time value (point plot)
+        self.animation_frame = ttk.Frame(self.left_frame)
+        self.animate_var = tk.BooleanVar()
+        self.animate_check = ttk.Checkbutton(self.animation_frame, text="Animate", variable=self.animate_var, command=self.update_plot_type)
+        self.animate_check.grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        self.frame_columns_label = ttk.Label(self.animation_frame, text="Frame Columns:")
+        self.frame_columns_label.grid(row=1, column=0, padx=5, pady=5, sticky="nw")
+        self.frame_columns_list = tk.Listbox(self.animation_frame, selectmode=tk.MULTIPLE, exportselection=False, height=6,
+                                             bg='#464646', fg='#ffffff', selectbackground='#808080', highlightthickness=0)
+        self.frame_columns_list.insert(tk.END, *self.columns)
+        self.frame_columns_list.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+        self.time_column_label = ttk.Label(self.animation_frame, text="Time Column:")
+        self.time_column_label.grid(row=2, column=0, padx=5, pady=5, sticky="w")
+        self.time_column_var = tk.StringVar(self)
+        self.time_column_menu = ttk.OptionMenu(self.animation_frame, self.time_column_var, self.columns[0], *self.columns)
+        self.time_column_menu.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
+        self.animation_buttons = ttk.Frame(self.animation_frame)
+        self.play_button = ttk.Button(self.animation_buttons, text="Play/Pause", command=self.toggle_playback)
+        self.play_button.pack(side=tk.LEFT, padx=5)
+        self.export_animation_button = ttk.Button(self.animation_buttons, text="Export Animation", command=self.export_animation)
+        self.export_animation_button.pack(side=tk.LEFT, padx=5)
+        self.animation_buttons.grid(row=3, column=0, columnspan=2, pady=5)
+        self.animation_frame.pack(pady=10)
+
         self.update_plot_type()  # Ensure the correct widgets are shown based on plot type
 
     def toggle_size_based_column(self):
@@ -190,6 +476,10 @@ class Application(ttk.Frame):
             self.var_menu.grid()
             self.color_scheme_label.grid()
             self.color_scheme_menu.grid()
+            self.aggregate_label.grid()
+            self.aggregate_menu.grid()
+            for widget in self.grid_widgets:
+                widget.grid_remove()
         elif self.plot_type_var.get() == 'point':
             self.lat_label.grid()
             self.lat_menu.grid()
@@ -208,16 +498,59 @@ class Application(ttk.Frame):
             self.var_menu.grid_remove()
             self.color_scheme_label.grid_remove()
             self.color_scheme_menu.grid_remove()
+            self.aggregate_label.grid_remove()
+            self.aggregate_menu.grid_remove()
+            for widget in self.grid_widgets:
+                widget.grid_remove()
+        elif self.plot_type_var.get() == 'grid':
+            self.lat_label.grid()
+            self.lat_menu.grid()
+            self.lon_label.grid()
+            self.lon_menu.grid()
+            self.color_scheme_label.grid()
+            self.color_scheme_menu.grid()
+            for widget in self.grid_widgets:
+                widget.grid()
+
+            self.dot_size_color_frame.pack_forget()
+            self.fill_countries_frame.pack_forget()
+            self.country_code_label.grid_remove()
+            self.country_code_menu.grid_remove()
+            self.shapefile_code_label.grid_remove()
+            self.shapefile_code_menu.grid_remove()
+            self.var_label.grid_remove()
+            self.var_menu.grid_remove()
+            self.aggregate_label.grid_remove()
+            self.aggregate_menu.grid_remove()
+        self.update_animation_widgets()
+
+    def update_animation_widgets(self):
+        plot_type = self.plot_type_var.get()
+        if plot_type == 'grid':
+            self.animation_frame.pack_forget()
+            return
+        self.animation_frame.pack_forget()
+        self.animation_frame.pack(pady=10)  # below the point plot frames update_plot_type may have re-packed
+        animate = self.animate_var.get()
+        for widget, shown in ((self.frame_columns_label, plot_type == 'choropleth'), (self.frame_columns_list, plot_type == 'choropleth'),
+                              (self.time_column_label, plot_type == 'point'), (self.time_column_menu, plot_type == 'point'),
+                              (self.animation_buttons, True)):
+            if animate and shown:
+                widget.grid()
+            else:
+                widget.grid_remove()
 
     def choose_dot_color(self):
         color_code = colorchooser.askcolor(title="Choose Dot Color")
         if color_code[1] is not None:
             self.dot_color = color_code[1]
+            self.schedule_restyle()
 
     def choose_fill_color(self):
         color_code = colorchooser.askcolor(title="Choose Fill Color")
         if color_code[1] is not None:
             self.fill_color = color_code[1]
+            self.schedule_restyle()
 
     def select_file(self):
         self.file_path = filedialog.askopenfilename(
@@ -235,18 +568,16 @@ class Application(ttk.Frame):
 
 
     def load_file(self):
-        file_extension = self.file_path.split('.')[-1].lower()
-        if file_extension == 'csv':
-            self.data = pd.read_csv(self.file_path, header=0 if self.header_var.get() else None)
-        elif file_extension in ['xls', 'xlsx']:
-            self.data = pd.read_excel(self.file_path, header=0 if self.header_var.get() else None)
-        elif file_extension == 'tsv':
-            self.data = pd.read_csv(self.file_path, sep='\t', header=0 if self.header_var.get() else None)
-        else:
-            messagebox.showerror("File Error", "Unsupported file format!")
+        # Only the header is read here; the selected columns are loaded when plotting
+        from map_render import read_columns
+        try:
+            self.columns = read_columns(self.file_path, self.header_var.get())
+        except ValueError as e:
+            messagebox.showerror("File Error", str(e))
             return
-        
-        self.columns = self.data.columns.tolist()
+        self.data_header = self.header_var.get()
+        # Menus hold labels as strings, files without a header have integer labels
+        self.column_labels = {str(column): column for column in self.columns}
         self.header_check.state(['disabled'])
         self.load_file_button.pack_forget()  # Hide the load file button after loading
         self.upload_shapefile_button.pack_forget()  # Hide the upload shapefile button after loading
@@ -263,114 +594,260 @@ class Application(ttk.Frame):
         self.save_button.state(['!disabled'])
 
     def upload_shapefile(self):
-        self.shapefile_path = filedialog.askopenfilename(
+        path = filedialog.askopenfilename(
             filetypes=[
                 ("Shapefiles", "*.shp"),
                 ("All files", "*.*")
             ]
         )
-        if self.shapefile_path:
-            self.geo_data = gpd.read_file(self.shapefile_path)
-            self.geo_data = self.geo_data.to_crs(epsg=3035)
-            self.geo_data = self.geo_data[self.geo_data.is_valid]
-            print("Uploaded shapefile loaded.")
+        if path:
+            # Read, reprojected and validated off the Tk thread; the buttons wait for it
+            def work():
+                from map_render import load_boundaries
+                with RenderTrace('shapefile') as trace:
+                    geo_data = load_boundaries(path)
+                return path, geo_data, trace
+
+            self.upload_shapefile_button.state(['disabled'])
+            self.load_file_button.state(['disabled'])
+            self.load_in_background("Loading shapefile...", work, self.shapefile_loaded, self.shapefile_failed)
+
+    def shapefile_loaded(self, result):
+        self.shapefile_path, self.geo_data, trace = result
+        print(f"Uploaded shapefile loaded in {trace.summary()}.")
+        self.status_label.configure(text="Shapefile loaded")
+        self.upload_shapefile_button.state(['!disabled'])
+        self.load_file_button.state(['!disabled'])
+
+    def shapefile_failed(self, error):
+        self.status_label.configure(text="Shapefile failed to load")
+        self.upload_shapefile_button.state(['!disabled'])
+        if self.geo_data is not None:
+            self.load_file_button.state(['!disabled'])
+        messagebox.showerror("Shapefile Error", str(error))
+
+    def render_settings(self):
+        # Snapshot of the Tk variables, taken on the Tk thread before handing off to the worker
+        column = lambda var: self.column_labels[var.get()]
+        animate = self.animate_var.get()
+        return {
+            'plot_type': self.plot_type_var.get(),
+            'country_code': column(self.country_code_var),
+            'shapefile_code': self.shapefile_code_var.get(),
+            'variable': column(self.var_var),
+            'color_scheme': self.color_scheme_var.get(),
+            'lat': column(self.lat_var),
+            'lon': column(self.lon_var),
+            'dot_color': self.dot_color,
+            'dot_size': self.dot_size_slider.get(),
+            'size_column': column(self.size_based_column_var) if self.size_based_var.get() else None,
+            'fill_countries': self.fill_countries_var.get(),
+            'fill_color': self.fill_color,
+            'drop_outside': self.drop_outside_var.get(),
+            'grid_size': self.grid_size_var.get(),
+            'grid_statistic': self.grid_statistic_var.get(),
+            'grid_column': column(self.grid_column_var),
+            'frame_columns': self.frame_columns() if animate and self.plot_type_var.get() == 'choropleth' else None,
+            'time_column': column(self.time_column_var) if animate and self.plot_type_var.get() == 'point' else None,
+            'aggregate': self.aggregate_var.get(),
+        }
+
+    def frame_columns(self):
+        # Selected columns in file order, or None for a static map
+        selected = [self.columns[i] for i in self.frame_columns_list.curselection()]
+        return selected or None
+
+    def set_render_status(self, message, busy):
+        self.status_label.configure(text=message)
+        if busy:
+            self.progress_bar.start(10)
+            self.cancel_button.state(['!disabled'])
+        else:
+            self.progress_bar.stop()
+            self.cancel_button.state(['disabled'])
+
+    def show_render_error(self, error):
+        messagebox.showerror("Render Error", str(error))
+
+    def new_trace(self, label, settings):
+        # Every render is timed for the status bar; the JSON trace and the profile are opt-in
+        name = os.path.join(trace_dir(), f"{label}-{time.strftime('%Y%m%d-%H%M%S')}")
+        profile = self.profile_var.get()
+        self.profile_var.set(False)  # only the next render is profiled
+        return RenderTrace(label, path=name + '.json' if self.trace_var.get() else None,
+                           profile_path=name + '.prof' if profile else None,
+                           datafile=self.file_path, shapefile=self.shapefile_path, settings=settings)
+
+    def show_trace(self, trace):
+        message = f"Done in {trace.summary()}"
+        if trace.path:
+            message += f"\nTrace: {trace.path}"
+        if trace.profile_path:
+            message += f"\nProfile: {trace.profile_path}"
+        self.status_label.configure(text=message)
+
+    def schedule_restyle(self):
+        # Coalesces slider drags and menu changes into one restyle per idle cycle
+        if not self.restyle_pending:
+            self.restyle_pending = True
+            self.after_idle(self.restyle)
+
+    def restyle(self):
+        self.restyle_pending = False
+        if self.map_figure is None or self.renderer.active('preview'):
+            return False
+        if self.map_source != (self.geo_data, self.file_path, self.data_header):
+            return False
+        settings = self.render_settings()
+        if settings == self.map_figure.settings or not self.map_figure.restyle(settings):
+            return False
+        self.blitter.update()
+        return True
 
     def plot(self):
-        proj = ccrs.LambertAzimuthalEqualArea(central_longitude=10, central_latitude=52, false_easting=4321000, false_northing=3210000)
-
-        self.fig, ax = plt.subplots(figsize=(10, 10), subplot_kw={'projection': proj})
-        ax.set_extent([-20, 45, 30, 75], crs=ccrs.PlateCarree())  # Set extent to focus on Europe
-
-        # Plot the base map with borders
-        self.geo_data.boundary.plot(ax=ax, linewidth=1, edgecolor='black')
-
-        plot_type = self.plot_type_var.get()
-        if plot_type == 'choropleth':
-            # Plot the data overlay for choropleth
-            merged_data = self.geo_data.set_index(self.shapefile_code_var.get()).join(self.data.set_index(self.country_code_var.get()))
-            merged_data.plot(column=self.var_var.get(), ax=ax, legend=False, cmap=self.color_scheme_var.get(), edgecolor='black', missing_kwds={"color": "lightgrey"})
-        elif plot_type == 'point':
-            # Plot the data overlay for point plot
-            for index, row in self.data.iterrows():
-                lat = row[self.lat_var.get()]
-                lon = row[self.lon_var.get()]
-                size = self.dot_size_slider.get()
-                if self.size_based_var.get():
-                    size = row[self.size_based_column_var.get()] / self.data[self.size_based_column_var.get()].max() * 20
-                ax.plot(lon, lat, 'o', color=self.dot_color, markersize=size, transform=ccrs.PlateCarree())
-
-            if self.fill_countries_var.get():
-                self.geo_data['filled'] = False
-                for index, row in self.data.iterrows():
-                    lat = row[self.lat_var.get()]
-                    lon = row[self.lon_var.get()]
-                    point = gpd.GeoSeries([gpd.points_from_xy([lon], [lat])[0]], crs="EPSG:4326").to_crs(epsg=3035)
-                    countries_containing_point = self.geo_data[self.geo_data.contains(point[0])]
-                    if not countries_containing_point.empty:
-                        self.geo_data.loc[countries_containing_point.index, 'filled'] = True
-                self.geo_data[self.geo_data['filled']].plot(ax=ax, color=self.fill_color, edgecolor='black')
-                self.geo_data[~self.geo_data['filled']].plot(ax=ax, color='none', edgecolor='black')
-
-        ax.coastlines(resolution='50m')
-        #ax.gridlines(draw_labels=True)
-
-        ax.spines['geo'].set_visible(False)  # Remove the rectangle border
-
+        # Style-only changes are applied to the map on screen; pressing PLOT again unchanged rebuilds it
+        if self.restyle():
+            return
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from map_render import build_figure, join_report, load_plot_data
+        geo_data, settings = self.geo_data, self.render_settings()
+        file_path, header = self.file_path, self.data_header
+        trace = self.new_trace('plot', settings)
+
+        def work(step):
+            with trace:
+                step("Loading data")
+                data = load_plot_data(file_path, header, settings)
+                map_figure = build_figure(geo_data, data, settings, step=step)
+                step("Rendering")
+                # Off-screen draw so cartopy's projection caches are filled on the worker, not the Tk thread
+                with stage("Canvas draw"):
+                    FigureCanvasAgg(map_figure.figure).draw()
+            return map_figure
+
+        def done(map_figure):
+            self.show_figure(map_figure, (geo_data, file_path, header))
+            self.show_trace(trace)
+            if map_figure.join is not None:
+                self.status_label.configure(text=f"{self.status_label.cget('text')}\n{join_report(map_figure.join)}")
+
+        self.renderer.submit('preview', work, done, self.show_render_error)
+
+    def toggle_playback(self):
+        if self.playback is not None:
+            self.stop_playback()
+        elif self.map_figure is not None and self.map_figure.frames:
+            self.playback = self.after(ANIMATION_INTERVAL, self.next_frame)
+
+    def stop_playback(self):
+        if self.playback is not None:
+            self.after_cancel(self.playback)
+            self.playback = None
+
+    def next_frame(self):
+        # Preview playback: only the data layer is redrawn over the cached base map
+        if not self.renderer.active('preview'):
+            frames = self.map_figure.frames
+            self.map_figure.show_frame((self.map_figure.frame + 1) % len(frames))
+            self.blitter.update()
+        self.playback = self.after(ANIMATION_INTERVAL, self.next_frame)
+
+    def clear_map(self):
+        self.stop_playback()
+        if self.blitter is not None:
+            self.blitter.disconnect()
+        self.fig = self.map_figure = self.map_source = self.blitter = None
         for widget in self.map_frame.winfo_children():
             widget.destroy()
 
+    def show_figure(self, map_figure, source):
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.clear_map()
+
+        self.fig = map_figure.figure
+        self.map_figure = map_figure
+        self.map_source = source
         canvas = FigureCanvasTkAgg(self.fig, master=self.map_frame)
+        self.blitter = LayerBlitter(canvas, map_figure)
         canvas.draw()
         canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
         self.save_button.state(['!disabled'])
 
+    def confirm_export(self):
+        # A new export replaces the one still being written, so ask first
+        if not self.renderer.active('export'):
+            return True
+        return messagebox.askyesno("Export in progress", "An export is still being written. Cancel it and start this one?")
+
     def save_to_disk(self):
-        file_path = filedialog.asksaveasfilename(defaultextension=".svg", filetypes=[("SVG files", "*.svg")])
+        if not self.confirm_export():
+            return
+        file_path = filedialog.asksaveasfilename(defaultextension=".svg", filetypes=[
+            ("SVG files", "*.svg"), ("Compressed SVG files", "*.svgz"), ("PDF files", "*.pdf"), ("PNG images", "*.png")])
+        if file_path:
+            from map_render import export_map, load_plot_data
+            geo_data, settings = self.geo_data, self.render_settings()
+            data_path, header = self.file_path, self.data_header
+            trace = self.new_trace('export', settings)
+
+            def work(step):
+                with trace:
+                    step("Loading data")
+                    data = load_plot_data(data_path, header, settings)
+                    return export_map(geo_data, data, settings, file_path, step=step)
+
+            def done(path):
+                self.show_trace(trace)
+                messagebox.showinfo("Save to Disk", f"Map saved as {path}")
+
+            self.renderer.submit('export', work, done, self.show_render_error)
+
+    def export_animation(self):
+        settings = self.render_settings()
+        if not settings['frame_columns'] and settings['time_column'] is None:
+            messagebox.showerror("Export Animation", "Select the frame columns to animate")
+            return
+        if not self.confirm_export():
+            return
+        file_path = filedialog.asksaveasfilename(defaultextension=".gif", filetypes=[
+            ("GIF animations", "*.gif"), ("MP4 videos", "*.mp4"), ("SVG files, one per frame", "*.svg")])
         if file_path:
-            proj = ccrs.LambertAzimuthalEqualArea(central_longitude=10, central_latitude=52, false_easting=4321000, false_northing=3210000)
-
-            high_res_fig, high_res_ax = plt.subplots(figsize=(20, 20), subplot_kw={'projection': proj})
-            high_res_ax.set_extent([-20, 45, 30, 75], crs=ccrs.PlateCarree())  # Set extent to focus on Europe
-
-            # Plot the base map with borders
-            self.geo_data.boundary.plot(ax=high_res_ax, linewidth=1, edgecolor='black')
-
-            plot_type = self.plot_type_var.get()
-            if plot_type == 'choropleth':
-                # Plot the data overlay for choropleth
-                merged_data = self.geo_data.set_index(self.shapefile_code_var.get()).join(self.data.set_index(self.country_code_var.get()))
-                merged_data.plot(column=self.var_var.get(), ax=high_res_ax, cmap=self.color_scheme_var.get(), edgecolor='black', missing_kwds={"color": "lightgrey"})
-            elif plot_type == 'point':
-                # Scale the dot size to match the figure size ratio
-                scale_factor = 20 / 10  # High-res figure size / low-res figure size
-                for index, row in self.data.iterrows():
-                    lat = row[self.lat_var.get()]
-                    lon = row[self.lon_var.get()]
-                    size = self.dot_size_slider.get() * scale_factor
-                    if self.size_based_var.get():
-                        size = row[self.size_based_column_var.get()] / self.data[self.size_based_column_var.get()].max() * 20 * scale_factor
-                    high_res_ax.plot(lon, lat, 'o', color=self.dot_color, markersize=size, transform=ccrs.PlateCarree())
-
-                if self.fill_countries_var.get():
-                    self.geo_data['filled'] = False
-                    for index, row in self.data.iterrows():
-                        lat = row[self.lat_var.get()]
-                        lon = row[self.lon_var.get()]
-                        point = gpd.GeoSeries([gpd.points_from_xy([lon], [lat])[0]], crs="EPSG:4326").to_crs(epsg=3035)
-                        countries_containing_point = self.geo_data[self.geo_data.contains(point[0])]
-                        if not countries_containing_point.empty:
-                            self.geo_data.loc[countries_containing_point.index, 'filled'] = True
-                    self.geo_data[self.geo_data['filled']].plot(ax=high_res_ax, color=self.fill_color, edgecolor='black')
-                    self.geo_data[~self.geo_data['filled']].plot(ax=high_res_ax, color='none', edgecolor='black')
-
-            high_res_ax.coastlines(resolution='10m')
-            #high_res_ax.gridlines(draw_labels=True)
-            high_res_ax.spines['geo'].set_visible(False)  # Remove the rectangle border
-
-            high_res_fig.savefig(file_path, format='svg')
-            plt.close(high_res_fig)
-            messagebox.showinfo("Save to Disk", f"Map saved as {file_path}")
+            from map_render import export_animation, load_plot_data
+            geo_data = self.geo_data
+            data_path, header = self.file_path, self.data_header
+            trace = self.new_trace('animation', settings)
+
+            def work(step):
+                with trace:
+                    step("Loading data")
+                    data = load_plot_data(data_path, header, settings)
+                    return export_animation(geo_data, data, settings, file_path, step=step)
+
+            def done(path):
+                self.show_trace(trace)
+                messagebox.showinfo("Export Animation", f"Animation saved as {path}")
+
+            self.renderer.submit('export', work, done, self.show_render_error)
+
+    def export_grid(self):
+        if not self.confirm_export():
+            return
+        file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        if file_path:
+            from map_render import load_plot_data
+            settings = self.render_settings()
+            data_path, header = self.file_path, self.data_header
+
+            def work(step):
+                step("Binning points")
+                grid = load_plot_data(data_path, header, settings)
+                step("Writing grid cells")
+                grid.to_frame().to_csv(file_path, index=False)
+                return file_path
+
+            self.renderer.submit('export', work, lambda path: messagebox.showinfo("Export Grid Cells", f"Grid saved as {path}"),
+                                 self.show_render_error)
 
     def reset(self):
         self.select_file_button.state(['!disabled'])
@@ -378,15 +855,18 @@ class Application(ttk.Frame):
         self.load_file_button.pack_forget()  # Hide the load file button
         self.plot_button.state(['disabled'])
         self.save_button.state(['disabled'])
+        self.renderer.cancel()
 
-        self.preload_shapefile()  # Reset to default shapefile
+        if self.default_geo_data is not None:  # Reset to default shapefile, or keep an upload if the default failed
+            self.shapefile_path, self.geo_data = self.default_shapefile, self.default_geo_data
+        if self.geo_data is None:
+            self.load_file_button.state(['disabled'])
 
         # Destroy only the dynamically created widgets
         for widget in self.left_frame.winfo_children():
-            if widget not in {self.select_file_button, self.header_check, self.plot_type_frame, self.load_file_button, self.reset_plot_frame, self.upload_shapefile_button}:
+            if widget not in {self.select_file_button, self.header_check, self.plot_type_frame, self.load_file_button, self.reset_plot_frame, self.upload_shapefile_button, self.status_frame, self.diagnostics_frame}:
                 widget.destroy()
-        for widget in self.map_frame.winfo_children():
-            widget.destroy()
+        self.clear_map()
 
         # Reset to initial UI
         self.select_file_button.pack(pady=10)
@@ -398,18 +878,19 @@ class Application(ttk.Frame):
         # Hide the reset plot frame until needed
         self.reset_plot_frame.pack_forget()
 
-        # Re-pack the reset_plot_frame to the bottom
+        # Re-pack the reset_plot_frame to the bottom, with the render status above it
         self.reset_plot_frame.pack(side=tk.BOTTOM, pady=10)
+        self.status_frame.pack_forget()
+        self.status_frame.pack(side=tk.BOTTOM, pady=10)
+        self.diagnostics_frame.pack_forget()
+        self.diagnostics_frame.pack(side=tk.BOTTOM, pady=(0, 10))
 
 
-root = ThemedTk(theme="equilux")
-root.set_theme("equilux")
-
-app = Application(master=root)
-app.mainloop()
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # animation frames are rendered in spawned processes
+    root = ThemedTk(theme="equilux")
+    root.set_theme("equilux")
 
-while True:
-    wait = input("Press q to quit: ")
-    if wait.lower() == 'q':
-        break
+    app = Application(master=root)
+    app.mainloop()
 
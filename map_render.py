@@ -0,0 +1,1450 @@
+import os
+import re
+import sys
+import gzip
+import json
+import glob
+import shutil
+import hashlib
+import weakref
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from PIL import Image
+from pyproj import Transformer
+from matplotlib import colormaps, rcParams
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import Collection, LineCollection, PolyCollection
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from matplotlib.image import AxesImage
+import cartopy.crs as ccrs
+from render_trace import stage
+
+# Map building shared by the Tk application and the headless batch renderer; must not import tkinter
+
+
+PLATE_CARREE = ccrs.PlateCarree()
+MAP_EPSG = 3035  # EEA reference grid, LAEA 10E/52N
+MAP_PROJECTION = ccrs.LambertAzimuthalEqualArea(central_longitude=10, central_latitude=52, false_easting=4321000, false_northing=3210000)
+MAP_EXTENT = [-20, 45, 30, 75]  # lon/lat extent focused on Europe
+LOD_TOLERANCES = (0, 250, 1000, 4000)  # simplification tolerances in LAEA metres, 0 is full detail
+MAX_DOT_SIZE = 20  # points; the dot size slider's maximum and the size of the largest size-based dot
+EXPORT_DPI = 300
+
+
+def boundary_cache_dir():
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'geospatial_data_plotter', 'boundaries')
+
+
+_boundary_cache = {}  # cache key -> projected, validated GeoDataFrame, least recently used first
+MAX_CACHED_SHAPEFILES = 4  # boundary frames, and their LODs, kept in memory
+
+
+def boundary_cache_key(path, epsg):
+    # A shapefile is several sidecar files, any of which can change the result
+    path = os.path.abspath(path)
+    stem = os.path.splitext(path)[0]
+    files = sorted(glob.glob(glob.escape(stem) + '.*')) or [path]
+    stats = [(os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files]
+    return json.dumps({'path': path, 'files': stats, 'epsg': epsg})
+
+
+def cached_geo_frame(name, key, build):
+    # GeoParquet disk cache: name picks the file, key (a string) must match its sidecar to reuse it
+    cache_file = os.path.join(boundary_cache_dir(), name + '.parquet')
+    key_file = os.path.join(boundary_cache_dir(), name + '.json')
+    try:
+        with open(key_file) as f:
+            if f.read() == key:
+                with stage("Read boundary cache") as counts:
+                    geo_data = gpd.read_parquet(cache_file)
+                    counts['rows'] = len(geo_data)
+                return geo_data
+    except (OSError, ValueError, ImportError):
+        pass
+
+    geo_data = build()
+    try:
+        os.makedirs(boundary_cache_dir(), exist_ok=True)
+        geo_data.to_parquet(cache_file)
+        with open(key_file, 'w') as f:
+            f.write(key)
+    except (OSError, ValueError, ImportError) as e:
+        print(f"Could not write boundary cache: {e}")
+    return geo_data
+
+
+def load_boundaries(path, epsg=MAP_EPSG):
+    # Read, reproject and validity-filter a boundary file, reusing the in-memory and on-disk caches
+    key = boundary_cache_key(path, epsg)
+    if key in _boundary_cache:
+        _boundary_cache[key] = _boundary_cache.pop(key)  # most recently used last
+        return _boundary_cache[key]
+
+    def read():
+        with stage("Read shapefile") as counts:
+            geo_data = gpd.read_file(path)
+            counts['rows'] = len(geo_data)
+            counts['vertices'] = lambda: int(shapely.get_num_coordinates(np.asarray(geo_data.geometry.values)).sum())
+        with stage("Reproject"):
+            geo_data = geo_data.to_crs(epsg=epsg)
+        # Ensure geometries are valid
+        with stage("Validity filter") as counts:
+            geo_data = geo_data[geo_data.is_valid]
+            counts['rows'] = len(geo_data)
+        return geo_data
+
+    name = hashlib.sha1(json.dumps([os.path.abspath(path), epsg]).encode()).hexdigest()
+    geo_data = cached_geo_frame(name, key, read)
+    _boundary_cache[key] = geo_data
+    while len(_boundary_cache) > MAX_CACHED_SHAPEFILES:
+        _boundary_cache.pop(next(iter(_boundary_cache)))
+    return geo_data
+
+
+def visible_points(ax, x, y, scale_factor=1):
+    # Points whose marker can show inside the axes; the margin is the radius of the largest dot
+    (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+    # The equal-aspect map shrinks its box along one axis when drawn, the larger ratio is the final scale
+    units_per_point = max((x1 - x0) / ax.bbox.width, (y1 - y0) / ax.bbox.height) * ax.figure.dpi / 72
+    margin = MAX_DOT_SIZE * scale_factor / 2 * units_per_point
+    return (x >= x0 - margin) & (x <= x1 + margin) & (y >= y0 - margin) & (y <= y1 + margin)
+
+
+def dot_sizes(values, scale_factor=1):
+    # Dot diameters scaled so the largest value gets MAX_DOT_SIZE; NaN where a value gives no dot,
+    # and everywhere when no value is positive, as in an empty file
+    finite = values[np.isfinite(values)]
+    largest = finite.max() if len(finite) else np.nan
+    if not largest > 0:
+        return np.full(len(values), np.nan)
+    return values / largest * MAX_DOT_SIZE * scale_factor
+
+
+def draw_points(ax, data, lat_column, lon_column, color, size, size_column=None, scale_factor=1):
+    # Project every coordinate in one call and draw them as batched collections,
+    # leaving out points off the map so they cost nothing to draw or export
+    lon = pd.to_numeric(data[lon_column], errors='coerce').to_numpy(dtype=float)
+    lat = pd.to_numeric(data[lat_column], errors='coerce').to_numpy(dtype=float)
+    xyz = ax.projection.transform_points(PLATE_CARREE, lon, lat)
+    x, y = xyz[:, 0], xyz[:, 1]
+
+    if size_column is None:
+        keep = visible_points(ax, x, y, scale_factor)
+        # scatter sizes are marker areas, markersize in ax.plot was the diameter
+        return [ax.scatter(x[keep], y[keep], s=(size * scale_factor) ** 2, color=color, marker='o', zorder=2)]
+
+    values = pd.to_numeric(data[size_column], errors='coerce').to_numpy(dtype=float)
+    sizes = dot_sizes(values, scale_factor)
+    keep = np.isfinite(sizes) & (sizes > 0) & visible_points(ax, x, y, scale_factor)
+    x, y, sizes = x[keep], y[keep], sizes[keep]
+    if not len(sizes):
+        return []
+
+    # Agg only takes its fast marker path when a collection has a single size, so
+    # group the points into half-point size classes, largest first so small dots stay visible
+    size_classes, class_index = np.unique(np.round(sizes * 2) / 2, return_inverse=True)
+    order = np.argsort(class_index, kind='stable')
+    bounds = np.searchsorted(class_index[order], np.arange(len(size_classes) + 1))
+    collections = []
+    for i in range(len(size_classes) - 1, -1, -1):
+        members = order[bounds[i]:bounds[i + 1]]
+        collections.append(ax.scatter(x[members], y[members], s=size_classes[i] ** 2, color=color, marker='o', zorder=2))
+    return collections
+
+
+MAX_FRAMES = 1000  # frames of one animation: frame columns or distinct time values
+
+
+def frame_label(value):
+    # Time values read as floats still label their frame like the file does, 2020.0 -> 2020
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def point_frames(ax, data, settings, scale_factor=1):
+    # Labels and per-frame (offsets, sizes) of a time-series point plot, one frame per distinct
+    # time value in sorted order. Dot sizes are normalised over all frames so a size means the
+    # same in every frame; sizes is None when the dots have the slider's size.
+    lon = pd.to_numeric(data[settings['lon']], errors='coerce').to_numpy(dtype=float)
+    lat = pd.to_numeric(data[settings['lat']], errors='coerce').to_numpy(dtype=float)
+    xyz = ax.projection.transform_points(PLATE_CARREE, lon, lat)
+    x, y = xyz[:, 0], xyz[:, 1]
+    codes, labels = pd.factorize(data[settings['time_column']], sort=True)  # missing times get -1
+    if len(labels) > MAX_FRAMES:
+        raise ValueError(f"{settings['time_column']} has {len(labels)} distinct values, at most {MAX_FRAMES} frames are supported")
+
+    keep = visible_points(ax, x, y, scale_factor) & (codes >= 0)
+    sizes = None
+    if settings['size_column'] is not None:
+        values = pd.to_numeric(data[settings['size_column']], errors='coerce').to_numpy(dtype=float)
+        sizes = dot_sizes(values, scale_factor)
+        keep &= np.isfinite(sizes) & (sizes > 0)
+    order = np.flatnonzero(keep)[np.argsort(codes[keep], kind='stable')]
+    bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+    offsets = np.column_stack([x[order], y[order]])
+    areas = sizes[order] ** 2 if sizes is not None else None
+    frames = [(offsets[bounds[i]:bounds[i + 1]], areas[bounds[i]:bounds[i + 1]] if areas is not None else None)
+              for i in range(len(labels))]
+    return [frame_label(label) for label in labels], frames
+
+
+JOIN_AGGREGATES = ('mean', 'sum', 'max')  # how the values of data rows sharing a code are combined
+
+
+def normalize_codes(values):
+    # Codes as comparable strings: trimmed, upper case, and integers without zero padding or a
+    # float's ".0", so 4, 4.0, "004" and " 004 " all match; missing codes stay missing
+    codes = pd.Series(values, copy=False).astype('string').str.strip().str.upper()
+    integer = codes.str.fullmatch(r'\d+(\.0*)?').fillna(False).to_numpy(dtype=bool)
+    if integer.any():
+        stripped = codes[integer].str.replace(r'\.0*$', '', regex=True).str.lstrip('0')
+        codes[integer] = stripped.mask(stripped == '', '0')
+    return codes.to_numpy(dtype=object, na_value=None)
+
+
+class CodeIndex:
+    # The normalized codes of one shapefile code column: codes holds the distinct codes,
+    # features the position in codes of every feature (-1 where it has none)
+    def __init__(self, values):
+        self.features, codes = pd.factorize(normalize_codes(values))
+        self.codes = pd.Index(codes)
+
+    def lookup(self, values):
+        # Position in codes of each value, -1 where the shapefile lacks it. Only the distinct
+        # values are normalized, a data column holds far fewer codes than rows.
+        value_codes, distinct = pd.factorize(np.asarray(values))
+        positions = np.append(self.codes.get_indexer(normalize_codes(distinct)), -1)  # value code -1 -> -1
+        return positions[value_codes], distinct, positions[:-1]
+
+    def gather(self, code_values):
+        # Per-code values onto the features, NaN for features without a code
+        return np.append(code_values, np.nan)[self.features]
+
+
+_data_positions = {}  # single entry: (CodeIndex, data, code column) -> positions of the data rows
+
+
+def code_index(geo_data, column):
+    # Kept on the frame's LOD, so it is dropped along with it
+    indexes = geometry_lod(geo_data).code_indexes
+    if column not in indexes:
+        indexes[column] = CodeIndex(geo_data[column].to_numpy())
+    return indexes[column]
+
+
+def aggregate_codes(positions, values, size, how):
+    # Vectorized many-to-one: combines the values of rows with the same code position
+    valid = (positions >= 0) & np.isfinite(values)
+    positions, values = positions[valid], values[valid]
+    counts = np.bincount(positions, minlength=size)
+    if how == 'max':
+        result = np.full(size, -np.inf)
+        np.maximum.at(result, positions, values)
+    elif how in ('sum', 'mean'):
+        result = np.bincount(positions, weights=values, minlength=size)
+        if how == 'mean':
+            result = result / np.maximum(counts, 1)
+    else:
+        raise ValueError(f"Unknown aggregate: {how}")
+    result[counts == 0] = np.nan
+    return result
+
+
+def join_values(geo_data, data, settings, columns):
+    # Values of the data columns for every feature of geo_data, matched on normalized codes
+    # through the shapefile's cached index; nothing is copied but the value arrays.
+    # Returns (features x columns values, categories or None, match statistics).
+    index = code_index(geo_data, settings['shapefile_code'])
+    key = (id(index), id(data), settings['country_code'])
+    cached = _data_positions.get(key)
+    if cached is None or cached[0] is not index or cached[1] is not data:
+        cached = (index, data, *index.lookup(data[settings['country_code']].to_numpy()))
+        _data_positions.clear()
+        _data_positions[key] = cached
+    positions, distinct, distinct_positions = cached[2:]
+
+    categories = None
+    values = []
+    for column in columns:
+        series = data[column]
+        if pd.api.types.is_numeric_dtype(series) or settings['frame_columns']:
+            column_values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=float)
+            values.append(index.gather(aggregate_codes(positions, column_values, len(index.codes), settings['aggregate'])))
+        else:
+            # Text values are categories, drawn as geopandas draws a categorical column;
+            # a code with several rows keeps its last one
+            category_codes, categories = pd.factorize(series, sort=True)
+            rows = np.flatnonzero((positions >= 0) & (category_codes >= 0))
+            last = np.full(len(index.codes), -1)
+            np.maximum.at(last, positions[rows], rows)
+            code_values = np.where(last >= 0, category_codes[np.maximum(last, 0)], np.nan)
+            values.append(index.gather(code_values))
+    values = np.column_stack(values) if values else np.empty((len(index.features), 0))
+
+    matched = positions >= 0
+    missed = distinct_positions < 0
+    rows_per_code = np.bincount(positions[matched], minlength=len(index.codes))
+    stats = {
+        'rows': len(data),
+        'matched_rows': int(matched.sum()),
+        'missed_codes': int(missed.sum()),
+        'missed_sample': [str(code) for code in distinct[missed][:5]],
+        'duplicate_codes': int((rows_per_code > 1).sum()),
+        'aggregate': settings['aggregate'],
+        'features': len(index.features),
+        'matched_features': int(np.isfinite(values).any(axis=1).sum()),
+    }
+    return values, categories, stats
+
+
+def join_report(stats):
+    # One line for the status bar
+    line = f"Matched {stats['matched_rows']} of {stats['rows']} rows to {stats['matched_features']} of {stats['features']} areas"
+    if stats['missed_codes']:
+        line += f"; {stats['missed_codes']} codes not in the shapefile, e.g. {', '.join(stats['missed_sample'])}"
+    if stats['duplicate_codes']:
+        line += f"; {stats['duplicate_codes']} codes with several rows ({stats['aggregate']})"
+    return line
+
+
+def feature_patches(boundaries):
+    # Row of each path geopandas draws: one per feature, one per member of a geometry
+    # collection, none for empty geometries
+    geometry = np.asarray(boundaries.geometry.values)
+    parts = np.where(shapely.get_type_id(geometry) == 7, shapely.get_num_geometries(geometry), 1)
+    parts[shapely.is_missing(geometry) | shapely.is_empty(geometry)] = 0
+    return np.repeat(np.arange(len(geometry)), parts)
+
+
+def choropleth_cmap(name):
+    # Missing values are drawn from the colormap's bad colour, as missing_kwds does for a static map
+    return colormaps[name].with_extremes(bad='lightgrey')
+
+
+def count_points_in_polygons(polygons, lon, lat):
+    # Per-polygon hit counts for lon/lat points, projected in one call and prefiltered by bounding box
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    x, y = Transformer.from_crs("EPSG:4326", polygons.crs, always_xy=True).transform(lon[valid], lat[valid])
+
+    # Points sorted on x act as the spatial index: each bbox becomes a slice plus a y mask
+    order = np.argsort(x)
+    x, y = x[order], y[order]
+    geometries = np.asarray(polygons.geometry.values)
+    bounds = shapely.bounds(geometries)
+    counts = np.zeros(len(geometries), dtype=np.int64)
+    for i, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+        start = np.searchsorted(x, bounds[i, 0], side='left')
+        stop = np.searchsorted(x, bounds[i, 2], side='right')
+        cx, cy = x[start:stop], y[start:stop]
+        candidates = (cy >= bounds[i, 1]) & (cy <= bounds[i, 3])
+        if not candidates.any():
+            continue
+        shapely.prepare(geometry)
+        counts[i] = shapely.contains_xy(geometry, cx[candidates], cy[candidates]).sum()
+    return counts
+
+
+def projected_extent(extent=MAP_EXTENT, projection=MAP_PROJECTION):
+    # Bounds of the lon/lat extent in map coordinates, following its curved edges
+    edge = np.linspace(0, 1, 64)
+    lon = np.concatenate([extent[0] + (extent[1] - extent[0]) * edge, np.full(64, extent[1]),
+                          extent[1] - (extent[1] - extent[0]) * edge, np.full(64, extent[0])])
+    lat = np.concatenate([np.full(64, extent[2]), extent[2] + (extent[3] - extent[2]) * edge,
+                          np.full(64, extent[3]), extent[3] - (extent[3] - extent[2]) * edge])
+    xyz = projection.transform_points(PLATE_CARREE, lon, lat)
+    return xyz[:, 0].min(), xyz[:, 1].min(), xyz[:, 0].max(), xyz[:, 1].max()
+
+
+def simplify_shared(geometry, tolerance):
+    # Douglas-Peucker on the arcs between border junctions rather than per feature: a border two
+    # features share is one arc, simplified once, so neighbours keep a common edge and no slivers
+    # or gaps open between them. Junctions are vertices with other than two distinct neighbours;
+    # vertices match within COASTLINE_SNAP. Rings that shrink below a triangle are dropped, so a
+    # feature smaller than the tolerance can come out empty. Non-polygonal features are simplified
+    # on their own.
+    geometry = np.asarray(geometry, dtype=object)
+    parts, part_feature = shapely.get_parts(geometry, return_index=True)
+    polygonal = shapely.get_type_id(parts) == 3
+    other = np.zeros(len(geometry), dtype=bool)
+    other[part_feature[~polygonal]] = True
+    keep = polygonal & ~other[part_feature]
+    parts, part_feature = parts[keep], part_feature[keep]
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, ring_of = shapely.get_coordinates(rings, return_index=True)
+    result = np.full(len(geometry), shapely.Polygon(), dtype=object)
+    result[other] = shapely.simplify(geometry[other], tolerance, preserve_topology=True)
+    if not len(coords):
+        return result
+
+    # Rings without their closing vertex, vertices numbered by snapped position
+    closing = np.r_[ring_of[1:] != ring_of[:-1], True]
+    coords, ring_of = coords[~closing], ring_of[~closing]
+    _, vertex = np.unique(np.round(coords / COASTLINE_SNAP).astype(np.int64), axis=0, return_inverse=True)
+    vertex = vertex.ravel()
+    starts = np.searchsorted(ring_of, np.arange(len(rings)))
+    ends = np.r_[starts[1:], len(vertex)]
+    following = np.arange(1, len(vertex) + 1)
+    following[ends - 1] = starts
+    edges = np.sort(np.column_stack([vertex, vertex[following]]), axis=1)
+    edges = np.unique(edges[edges[:, 0] != edges[:, 1]], axis=0)
+    junction = np.bincount(edges.ravel(), minlength=vertex.max() + 1)[vertex] != 2
+
+    # Cut every ring into arcs at its junctions; a ring without one is a single closed arc
+    # started at its lowest vertex, so both sides of an enclave border cut it the same way
+    arcs = {}  # vertex ids in canonical direction -> arc number
+    arc_positions = []  # coordinate positions of each arc, canonical direction
+    ring_arcs = []  # per ring: (arc number, reversed) in ring order
+    for start, end in zip(starts, ends):
+        positions = np.arange(start, end)
+        cuts = np.flatnonzero(junction[start:end])
+        first = cuts[0] if len(cuts) else np.argmin(vertex[start:end])
+        positions = np.roll(positions, -first)
+        cuts = np.r_[cuts - first if len(cuts) else 0, end - start]
+        pieces = []
+        for a, b in zip(cuts[:-1], cuts[1:]):
+            piece = np.r_[positions[a:b], positions[b % (end - start)]]
+            forward, backward = vertex[piece].tobytes(), vertex[piece[::-1]].tobytes()
+            key, reverse = (forward, False) if forward <= backward else (backward, True)
+            if key not in arcs:
+                arcs[key] = len(arc_positions)
+                arc_positions.append(piece[::-1] if reverse else piece)
+            pieces.append((arcs[key], reverse))
+        ring_arcs.append(pieces)
+
+    lengths = np.array([len(piece) for piece in arc_positions])
+    lines = shapely.linestrings(coords[np.concatenate(arc_positions)], indices=np.repeat(np.arange(len(lengths)), lengths))
+    simplified, arc_of = shapely.get_coordinates(shapely.simplify(lines, tolerance, preserve_topology=False), return_index=True)
+    arc_bounds = np.searchsorted(arc_of, np.arange(len(lengths) + 1))
+
+    # Rings back from their arcs, each arc without its last vertex, which starts the next one.
+    # Shells come before their part's holes; a part whose shell collapsed loses its holes too.
+    shell = np.r_[True, ring_part[1:] != ring_part[:-1]]
+    collapsed = np.zeros(len(parts), dtype=bool)
+    ring_coords, ring_index, ring_parts = [], [], []
+    for ring, pieces in enumerate(ring_arcs):
+        if collapsed[ring_part[ring]]:
+            continue
+        chain = np.concatenate([simplified[arc_bounds[arc]:arc_bounds[arc + 1]][::-1 if reverse else 1][:-1]
+                                for arc, reverse in pieces])
+        if len(chain) < 3:
+            collapsed[ring_part[ring]] = shell[ring]
+            continue
+        ring_coords.append(np.vstack([chain, chain[:1]]))
+        ring_index.append(np.full(len(chain) + 1, len(ring_parts)))
+        ring_parts.append(ring_part[ring])
+    if ring_parts:
+        new_rings = shapely.linearrings(np.concatenate(ring_coords), indices=np.concatenate(ring_index))
+        kept_parts, part_index = np.unique(ring_parts, return_inverse=True)
+        polygons = shapely.polygons(new_rings, indices=part_index)
+        shapely.multipolygons(polygons, indices=part_feature[kept_parts], out=result)
+    return result
+
+
+class GeometryLOD:
+    # Boundaries clipped to the map extent once, with simplified copies built on first use.
+    # rows holds the positions of the kept features in the source frame.
+    def __init__(self, geo_data, extent=MAP_EXTENT, margin=0.05):
+        xmin, ymin, xmax, ymax = projected_extent(extent)
+        # The margin keeps the artificial clip edges outside the visible map
+        dx, dy = (xmax - xmin) * margin, (ymax - ymin) * margin
+        self.bounds = (xmin - dx, ymin - dy, xmax + dx, ymax + dy)
+        self.width = xmax - xmin
+        self.lock = threading.Lock()
+
+        clipped = shapely.clip_by_rect(np.asarray(geo_data.geometry.values), *self.bounds)
+        self.rows = np.flatnonzero(~shapely.is_missing(clipped) & ~shapely.is_empty(clipped))
+        full = geo_data.iloc[self.rows].copy()
+        full.geometry = gpd.GeoSeries(clipped[self.rows], index=full.index, crs=geo_data.crs)
+        self.levels = {0: full}
+        self.coastline = None  # CoastlineLayer of the outline, when these are the coastline fallback
+        self.code_indexes = {}  # code column -> CodeIndex of the source frame
+
+    def level(self, tolerance):
+        with self.lock:
+            if tolerance not in self.levels:
+                full = self.levels[0]
+                simplified = simplify_shared(full.geometry.values, tolerance)
+                level = full.copy()
+                level.geometry = gpd.GeoSeries(simplified, index=full.index, crs=full.crs)
+                self.levels[tolerance] = level
+            return self.levels[tolerance]
+
+    def tolerance_for(self, width_inches, dpi):
+        # Coarsest level whose error stays under half an output pixel
+        metres_per_pixel = self.width / (width_inches * dpi)
+        return max(t for t in LOD_TOLERANCES if t <= metres_per_pixel / 2)
+
+    def vertex_count(self, tolerance):
+        return int(shapely.get_num_coordinates(np.asarray(self.level(tolerance).geometry.values)).sum())
+
+
+_geometry_lods = {}  # id(geo_data) -> (weak reference to geo_data, GeometryLOD), least recently used first
+_layer_lock = threading.RLock()  # builds LODs and coastline layers once when loaders and a render overlap
+
+
+def geometry_lod(geo_data):
+    # Entries go with their frame, so a recycled id() never finds a stale LOD, and only the most
+    # recently used frames keep theirs
+    key = id(geo_data)
+    with _layer_lock:
+        cached = _geometry_lods.pop(key, None)
+        if cached is None or cached[0]() is not geo_data:
+            forget = lambda ref: _geometry_lods.get(key, (None,))[0] is ref and _geometry_lods.pop(key, None)
+            cached = (weakref.ref(geo_data, forget), GeometryLOD(geo_data))
+        _geometry_lods[key] = cached
+        while len(_geometry_lods) > MAX_CACHED_SHAPEFILES:
+            _geometry_lods.pop(next(iter(_geometry_lods)))
+        return cached[1]
+
+
+COASTLINE_RESOLUTIONS = {'10m': 0, '50m': 1000, '110m': 4000}  # Natural Earth-style names -> simplification tolerance in metres
+COASTLINE_SNAP = 1  # metres; vertices this close count as the same point when matching shared borders
+
+
+def coastline_outline(countries):
+    # Coastline derived from the clipped country polygons without a union: every edge of every
+    # ring is counted, borders are shared by two neighbours and cancel out, coasts and lake shores
+    # appear once. Runs of consecutive remaining edges of a ring become one line each.
+    rings = shapely.get_rings(shapely.get_parts(np.asarray(countries.geometry.values)))
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    edges = np.flatnonzero(ring_index[1:] == ring_index[:-1])  # edge i runs from coords[i] to coords[i + 1]
+
+    # Direction-independent integer key per edge
+    a = np.round(coords[edges] / COASTLINE_SNAP).astype(np.int64)
+    b = np.round(coords[edges + 1] / COASTLINE_SNAP).astype(np.int64)
+    swap = (a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] > b[:, 1]))
+    keys = np.where(swap[:, None], np.hstack([b, a]), np.hstack([a, b]))
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    edges = edges[counts[inverse.ravel()] == 1]
+    if not len(edges):
+        return gpd.GeoDataFrame(geometry=[], crs=countries.crs)
+
+    # A run breaks where an edge was dropped; edges of different rings are never adjacent
+    run = np.cumsum(np.r_[True, edges[1:] != edges[:-1] + 1]) - 1
+    last = np.r_[run[1:] != run[:-1], True]
+    points = np.concatenate([edges, edges[last] + 1])
+    order = np.argsort(np.concatenate([run, run[last]]), kind='stable')
+    lines = shapely.linestrings(coords[points[order]], indices=np.sort(np.concatenate([run, run[last]])))
+    return gpd.GeoDataFrame(geometry=lines, crs=countries.crs)
+
+
+class CoastlineLayer:
+    # Projected coastlines clipped to the map extent, with simplified copies per tolerance
+    def __init__(self, lines):
+        self.lines = lines
+        self.levels = {}
+        self.lock = threading.Lock()
+
+    def level(self, tolerance):
+        with self.lock:
+            if tolerance not in self.levels:
+                geometry = np.asarray(self.lines.geometry.values)
+                if tolerance:
+                    geometry = shapely.simplify(geometry, tolerance, preserve_topology=True)
+                self.levels[tolerance] = geometry[~shapely.is_empty(geometry)]
+            return self.levels[tolerance]
+
+    def draw(self, ax, tolerance, **kwargs):
+        # One LineCollection in map coordinates, no per-render reprojection
+        paths = [shapely.get_coordinates(part) for part in shapely.get_parts(self.level(tolerance))]
+        collection = LineCollection(paths, transform=ax.transData, **kwargs)
+        ax.add_collection(collection, autolim=False)
+        return collection
+
+
+_coastline_layers = {}  # source cache key -> CoastlineLayer
+
+
+def load_coastlines(fallback=None):
+    # Prefers a bundled Natural Earth coastline file, then the outline of the bundled countries,
+    # then the outline of fallback (the boundaries being plotted), so no network is ever needed
+    if os.path.exists(COASTLINE_SHAPEFILE):
+        source = COASTLINE_SHAPEFILE
+    elif os.path.exists(DEFAULT_SHAPEFILE):
+        source = DEFAULT_SHAPEFILE
+    elif fallback is not None:
+        source = None
+    else:
+        raise FileNotFoundError(f"No coastline data: {COASTLINE_SHAPEFILE} and {DEFAULT_SHAPEFILE} are missing")
+
+    with _layer_lock:
+        if source is None:
+            # Kept on the frame's LOD, so it is dropped along with it
+            lod = geometry_lod(fallback)
+            if lod.coastline is None:
+                lod.coastline = CoastlineLayer(coastline_outline(lod.level(0)))
+            return lod.coastline
+
+        key = json.dumps([boundary_cache_key(source, MAP_EPSG), MAP_EXTENT, 'coastline'])
+        if key not in _coastline_layers:
+            def build():
+                lod = geometry_lod(load_boundaries(source))
+                if source == COASTLINE_SHAPEFILE:
+                    return lod.levels[0][['geometry']]
+                return coastline_outline(lod.levels[0])
+
+            name = hashlib.sha1(json.dumps([os.path.abspath(source), MAP_EPSG, 'coastline']).encode()).hexdigest()
+            _coastline_layers[key] = CoastlineLayer(cached_geo_frame(name, key, build))
+        return _coastline_layers[key]
+
+
+_point_counts_cache = {}  # single entry: (polygons, data, columns) -> counts of the last fill pass
+
+
+def cached_point_counts(polygons, data, lat_column, lon_column):
+    # Cached so the export does not repeat the preview's point-in-polygon pass
+    key = (id(polygons), id(data), lat_column, lon_column)
+    cached = _point_counts_cache.get(key)
+    if cached is not None and cached[0] is polygons and cached[1] is data:
+        return cached[2]
+    lon = pd.to_numeric(data[lon_column], errors='coerce')
+    lat = pd.to_numeric(data[lat_column], errors='coerce')
+    counts = count_points_in_polygons(polygons, lon, lat)
+    _point_counts_cache.clear()
+    _point_counts_cache[key] = (polygons, data, counts)
+    return counts
+
+
+STYLE_SETTINGS = ('color_scheme', 'dot_color', 'dot_size', 'fill_color')  # settings restyle() can apply in place
+
+
+class MapFigure:
+    # A built map: the figure plus its artists grouped into a base layer (boundaries),
+    # a data layer (choropleth, points, country fill) and an overlay layer (coastlines)
+    def __init__(self, figure, ax, settings, scale_factor):
+        self.figure = figure
+        self.ax = ax
+        self.settings = dict(settings)
+        self.scale_factor = scale_factor
+        self.layers = {'base': [], 'data': [], 'overlay': []}
+        self.choropleth = []
+        self.points = []
+        self.fill = []
+        self.grid = []
+        # Animated maps: frame labels, the current frame and what changes per frame, either
+        # choropleth values (paths x frames) or point (offsets, sizes) pairs
+        self.frames = []
+        self.frame = 0
+        self.frame_values = None
+        self.frame_points = None
+        self.frame_label = None
+        self.join = None  # choropleth match statistics, see join_values
+
+    def add(self, layer, artists):
+        self.layers[layer].extend(artists)
+        return artists
+
+    def restyle(self, settings):
+        # Applies style-only changes to the existing artists; False if the map must be rebuilt
+        if any(settings[key] != self.settings[key] for key in settings if key not in STYLE_SETTINGS):
+            return False
+        for collection in self.choropleth:
+            if collection.get_array() is not None:  # the missing-data collection has no values
+                collection.set_cmap(choropleth_cmap(settings['color_scheme']))
+        for artist in self.grid:
+            artist.set_cmap(settings['color_scheme'])
+        for collection in self.points:
+            collection.set_color(settings['dot_color'])
+            if settings['size_column'] is None:
+                collection.set_sizes([(settings['dot_size'] * self.scale_factor) ** 2])
+        for collection in self.fill:
+            collection.set_facecolor(settings['fill_color'])
+        self.settings = dict(settings)
+        return True
+
+    def show_frame(self, index):
+        # Swaps in one frame's values; the base map and the colour normalization stay as they are
+        self.frame = index
+        if self.frame_values is not None:
+            self.choropleth[0].set_array(np.ma.masked_invalid(self.frame_values[:, index]))
+        if self.frame_points is not None:
+            offsets, sizes = self.frame_points[index]
+            self.points[0].set_offsets(offsets)
+            if sizes is not None:
+                self.points[0].set_sizes(sizes)
+        self.frame_label.set_text(self.frames[index])
+
+    def restyled_artists(self):
+        # The data layer and every layer artist drawn on top of it, in draw order;
+        # everything below can be kept as a cached background
+        order = self.layers['base'] + self.layers['data'] + self.layers['overlay']
+        order = sorted(order, key=lambda artist: artist.get_zorder())  # stable, like the axes draw order
+        data = set(map(id, self.layers['data']))
+        first = next((i for i, artist in enumerate(order) if id(artist) in data), len(order))
+        return order[first:]
+
+
+def build_figure(geo_data, data, settings, figsize=(10, 10), scale_factor=1, coastline_resolution='50m', dpi=100, step=None):
+    # Builds the map off the pyplot state machine so it can run on a worker thread;
+    # step(message) is called between stages and may raise RenderCancelled
+    step = step or (lambda message: None)
+
+    step("Preparing map")
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot(projection=MAP_PROJECTION)
+    ax.set_extent(MAP_EXTENT, crs=PLATE_CARREE)
+    map_figure = MapFigure(fig, ax, settings, scale_factor)
+    new_collections = lambda before: ax.collections[before:]
+
+    # Clipped boundaries simplified to the output resolution, dpi is the output's not the figure's
+    step("Simplifying boundaries")
+    with stage("Simplify boundaries") as counts:
+        lod = geometry_lod(geo_data)
+        tolerance = lod.tolerance_for(figsize[0], dpi)
+        boundaries = lod.level(tolerance)
+        counts['tolerance'] = tolerance
+        counts['vertices'] = lambda: lod.vertex_count(tolerance)
+
+    # Plot the base map with borders; a choropleth outlines every feature itself, so it would be hidden
+    if settings['plot_type'] != 'choropleth':
+        step("Drawing boundaries")
+        with stage("Draw boundaries") as counts:
+            before = len(ax.collections)
+            boundaries.boundary.plot(ax=ax, linewidth=1, edgecolor='black')
+            map_figure.add('base', new_collections(before))
+            counts['rows'] = len(boundaries)
+
+    if settings['plot_type'] == 'choropleth':
+        # Plot the data overlay for choropleth: the boundaries drawn once as a single collection
+        # coloured from a value array; an animation swaps that array per frame column
+        columns = list(settings['frame_columns'] or [settings['variable']])
+        if len(columns) > MAX_FRAMES:
+            raise ValueError(f"{len(columns)} frame columns, at most {MAX_FRAMES} frames are supported")
+        step("Joining data")
+        with stage("Join") as counts:
+            values, categories, map_figure.join = join_values(geo_data, data, settings, columns)
+            values = values[lod.rows]  # onto the clipped features
+            counts.update(map_figure.join)
+        step("Drawing choropleth")
+        with stage("Draw choropleth") as counts:
+            before = len(ax.collections)
+            boundaries.plot(ax=ax, edgecolor='black')
+            map_figure.choropleth = map_figure.add('data', new_collections(before))
+            # One normalization over every frame so a colour means the same value throughout
+            finite = values[np.isfinite(values)]
+            if categories is not None:
+                vmin, vmax = 0, max(len(categories) - 1, 1)
+            else:
+                vmin, vmax = (finite.min(), finite.max()) if len(finite) else (0, 1)
+            values = values[feature_patches(boundaries)]
+            for collection in map_figure.choropleth:
+                collection.set_cmap(choropleth_cmap(settings['color_scheme']))
+                collection.set_norm(Normalize(vmin, vmax))
+                collection.set_array(np.ma.masked_invalid(values[:, 0]))
+            if settings['frame_columns']:
+                map_figure.frame_values = values
+                map_figure.frames = [frame_label(column) for column in columns]
+            counts['rows'] = len(boundaries)
+    elif settings['plot_type'] == 'point':
+        # Plot the data overlay for point plot
+        step("Drawing points")
+        with stage("Draw points") as counts:
+            if settings['time_column'] is not None:
+                # Animated points: one collection whose offsets are swapped per frame
+                map_figure.frames, map_figure.frame_points = point_frames(ax, data, settings, scale_factor)
+                map_figure.points = map_figure.add('data', [ax.scatter(np.empty(0), np.empty(0), s=(settings['dot_size'] * scale_factor) ** 2,
+                                                                       color=settings['dot_color'], marker='o', zorder=2)])
+                counts['frames'] = len(map_figure.frames)
+            else:
+                map_figure.points = map_figure.add('data', draw_points(ax, data, settings['lat'], settings['lon'], settings['dot_color'], settings['dot_size'],
+                                                                       size_column=settings['size_column'], scale_factor=scale_factor))
+            counts['rows'] = len(data)
+
+        if settings['fill_countries']:
+            step("Filling countries")
+            # Counted against the full geometry, then mapped onto the clipped features
+            with stage("Spatial fill") as counts:
+                filled = cached_point_counts(geo_data, data, settings['lat'], settings['lon'])[lod.rows] > 0
+                counts['rows'] = len(data)
+                counts['polygons'] = len(geo_data)
+                counts['filled'] = int(filled.sum())
+            # Unfilled countries are already outlined by the base layer
+            before = len(ax.collections)
+            if filled.any():
+                boundaries[filled].plot(ax=ax, color=settings['fill_color'], edgecolor='black')
+            map_figure.fill = map_figure.add('data', new_collections(before))
+
+    elif settings['plot_type'] == 'grid':
+        # data is a ReferenceGrid, drawn as a single image in map coordinates
+        step("Drawing grid")
+        with stage("Draw grid") as counts:
+            cells, values = data.statistic(settings['grid_statistic'])
+            x0, x1, y0, y1 = data.occupied_box(cells)
+            if (x1 - x0) * (y1 - y0) > DENSE_GRID_CELLS and len(cells) <= GRID_CELL_SQUARES:
+                # Few cells spread wide: one square each rather than a mostly empty raster
+                artist = PolyCollection(data.squares(cells), array=values, cmap=settings['color_scheme'],
+                                        edgecolors='none', transform=ax.transData, zorder=1)
+                ax.add_collection(artist, autolim=False)
+            else:
+                # A raster over the occupied box only
+                image, extent = data.image(cells, values)
+                artist = ax.imshow(image, extent=extent, origin='lower', transform=ax.projection,
+                                   cmap=settings['color_scheme'], interpolation='nearest', zorder=1)
+                ax.set_extent(MAP_EXTENT, crs=PLATE_CARREE)  # imshow rescales the axes to the image
+            counts['cells'] = len(cells)
+        map_figure.grid = map_figure.add('data', [artist])
+
+    step("Drawing coastlines")
+    with stage("Draw coastlines") as counts:
+        # Never finer than the output resolution, whatever resolution was asked for
+        coast_tolerance = max(COASTLINE_RESOLUTIONS[coastline_resolution], tolerance)
+        coastlines = load_coastlines(fallback=geo_data)
+        map_figure.add('overlay', [coastlines.draw(ax, coast_tolerance, colors='black', linewidths=1, zorder=1.5)])
+        counts['vertices'] = lambda: int(shapely.get_num_coordinates(coastlines.level(coast_tolerance)).sum())
+    #ax.gridlines(draw_labels=True)
+
+    if map_figure.frames:
+        map_figure.frame_label = map_figure.add('data', [ax.text(0.02, 0.98, '', transform=ax.transAxes, ha='left', va='top',
+                                                                 fontsize=14 * scale_factor, zorder=3)])[0]
+        map_figure.show_frame(0)
+
+    ax.spines['geo'].set_visible(False)  # Remove the rectangle border
+    return map_figure
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+GRID_SIZES = {'1km': 1000, '10km': 10000, '100km': 100000}  # EEA reference grid cell sizes in metres
+GRID_STATISTICS = ('count', 'sum', 'mean')
+DENSE_GRID_CELLS = 4_000_000  # above this many cells over the extent, occupied cells are kept sparsely
+GRID_CELL_SQUARES = 200_000  # occupied cells of a sparse grid drawn as squares instead of a raster
+
+
+def grid_cell_codes(size, easting, northing):
+    # EEA cell codes from cell indices, e.g. ('10km', 432, 321) -> 10kmE432N321
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        return size + 'E' + pd.Series(easting).astype(str) + 'N' + pd.Series(northing).astype(str)
+    # Arrow formats millions of codes several times faster than pandas string concatenation
+    codes = pc.binary_join_element_wise(size + 'E', pc.cast(pa.array(easting), pa.string()),
+                                        'N', pc.cast(pa.array(northing), pa.string()), '')
+    return codes.to_pandas()
+
+
+class ReferenceGrid:
+    # Point counts and value sums binned into EEA reference grid cells covering the map extent.
+    # Cells are aligned to the EPSG:3035 origin, so cell (i, j) has code <size>E<i>N<j>.
+    def __init__(self, size='10km', bounds=None):
+        self.size = size
+        self.cell_size = GRID_SIZES[size]
+        xmin, ymin, xmax, ymax = bounds or projected_extent()
+        self.ix0 = int(np.floor(xmin / self.cell_size))
+        self.iy0 = int(np.floor(ymin / self.cell_size))
+        self.nx = int(np.ceil(xmax / self.cell_size)) - self.ix0
+        self.ny = int(np.ceil(ymax / self.cell_size)) - self.iy0
+        self.transformer = Transformer.from_crs("EPSG:4326", f"EPSG:{MAP_EPSG}", always_xy=True)
+        self.dense = self.nx * self.ny <= DENSE_GRID_CELLS
+        # Flat cell ids (row * nx + column); dense grids index them directly
+        size = self.nx * self.ny if self.dense else 0
+        self.cells = np.arange(size, dtype=np.int64)
+        self.counts = np.zeros(size, dtype=np.int64)  # all points in the cell
+        self.value_counts = np.zeros(size, dtype=np.int64)  # points with a finite value
+        self.sums = np.zeros(size, dtype=np.float64)
+        self.pending = []  # per-chunk (cells, counts, value counts, sums) not yet merged, sparse grids only
+        self.pending_size = 0
+
+    def add(self, lon, lat, values=None):
+        x, y = self.transformer.transform(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        ix = np.floor(x / self.cell_size) - self.ix0
+        iy = np.floor(y / self.cell_size) - self.iy0
+        inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)  # also false for NaN
+        cells = iy[inside].astype(np.int64) * self.nx + ix[inside].astype(np.int64)
+        if values is None:
+            values = np.full(len(cells), np.nan)
+        else:
+            values = np.asarray(values, dtype=float)[inside]
+        has_value = np.isfinite(values)
+        values = np.where(has_value, values, 0.0)
+
+        if self.dense:
+            self.counts += np.bincount(cells, minlength=len(self.counts))
+            self.value_counts += np.bincount(cells, weights=has_value, minlength=len(self.counts)).astype(np.int64)
+            self.sums += np.bincount(cells, weights=values, minlength=len(self.counts))
+            return
+        # Sparse: reduce the chunk to its occupied cells now, merge into the sorted set in batches
+        unique_cells, index = np.unique(cells, return_inverse=True)
+        self.pending.append((unique_cells, np.bincount(index), np.bincount(index, weights=has_value),
+                             np.bincount(index, weights=values)))
+        self.pending_size += len(unique_cells)
+        if self.pending_size > max(len(self.cells), DENSE_GRID_CELLS):
+            self.merge_pending()
+
+    def merge_pending(self):
+        if not self.pending:
+            return
+        parts = [(self.cells, self.counts, self.value_counts, self.sums)] + self.pending
+        unique_cells, index = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+        self.cells = unique_cells
+        self.counts = np.bincount(index, weights=np.concatenate([part[1] for part in parts])).astype(np.int64)
+        self.value_counts = np.bincount(index, weights=np.concatenate([part[2] for part in parts])).astype(np.int64)
+        self.sums = np.bincount(index, weights=np.concatenate([part[3] for part in parts]))
+        self.pending = []
+        self.pending_size = 0
+
+    def statistic(self, name):
+        # (cell ids, values) of the occupied cells
+        self.merge_pending()
+        occupied = self.counts > 0
+        if name == 'count':
+            values = self.counts[occupied].astype(np.float64)
+        elif name == 'sum':
+            values = self.sums[occupied]
+        elif name == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = self.sums[occupied] / self.value_counts[occupied]
+        else:
+            raise ValueError(f"Unknown grid statistic {name!r}")
+        return self.cells[occupied], values
+
+    def occupied_box(self, cells):
+        # (column, row) bounds of the cells, end exclusive
+        if not len(cells):
+            return 0, 1, 0, 1
+        columns, rows = cells % self.nx, cells // self.nx
+        return int(columns.min()), int(columns.max()) + 1, int(rows.min()), int(rows.max()) + 1
+
+    def image(self, cells, values):
+        # Row-major raster of the values over the box of the occupied cells, NaN where a cell is
+        # empty, with its extent; the whole grid is never allocated
+        x0, x1, y0, y1 = self.occupied_box(cells)
+        image = np.full((y1 - y0, x1 - x0), np.nan, dtype=np.float32)
+        image[cells // self.nx - y0, cells % self.nx - x0] = values
+        return image, self.extent((x0, x1, y0, y1))
+
+    def squares(self, cells):
+        # (n, 4, 2) corners of the cells in map coordinates
+        x = (cells % self.nx + self.ix0) * self.cell_size
+        y = (cells // self.nx + self.iy0) * self.cell_size
+        corners = np.array([[0, 0], [1, 0], [1, 1], [0, 1]]) * self.cell_size
+        return np.stack([x, y], axis=1)[:, None, :] + corners
+
+    def extent(self, box=None):
+        x0, x1, y0, y1 = box or (0, self.nx, 0, self.ny)
+        return [(self.ix0 + x0) * self.cell_size, (self.ix0 + x1) * self.cell_size,
+                (self.iy0 + y0) * self.cell_size, (self.iy0 + y1) * self.cell_size]
+
+    def to_frame(self):
+        # Occupied cells with their standard EEA cell codes, e.g. 10kmE432N321
+        self.merge_pending()
+        cells = self.counts > 0
+        ids = self.cells[cells]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums[cells] / self.value_counts[cells]
+        return pd.DataFrame({
+            'cellcode': grid_cell_codes(self.size, ids % self.nx + self.ix0, ids // self.nx + self.iy0),
+            'count': self.counts[cells],
+            'sum': self.sums[cells],
+            'mean': mean,
+        })
+
+
+DEFAULT_SHAPEFILE = "_internal/ne_10m_admin_0_countries.shp"  # Path to the preloaded shapefile
+COASTLINE_SHAPEFILE = "_internal/ne_10m_coastline.shp"  # Optional bundled coastlines, used instead of the country outline
+
+DEFAULT_SETTINGS = {
+    'plot_type': 'choropleth',
+    'country_code': None,
+    'shapefile_code': None,
+    'variable': None,
+    'color_scheme': 'viridis_r',
+    'lat': None,
+    'lon': None,
+    'dot_color': '#FF0000',
+    'dot_size': 5,
+    'size_column': None,
+    'fill_countries': False,
+    'fill_color': '#00FF00',
+    'drop_outside': False,
+    'grid_size': '10km',
+    'grid_statistic': 'count',
+    'grid_column': None,
+    'frame_columns': None,  # choropleth: one animation frame per column
+    'time_column': None,  # point: one animation frame per distinct value
+    'aggregate': 'mean',  # choropleth: how rows sharing a code are combined, see JOIN_AGGREGATES
+}
+
+
+CHUNK_ROWS = 1_000_000  # rows per chunk when streaming without pyarrow
+ARROW_BLOCK_BYTES = 64 << 20
+
+
+def data_file_separator(path):
+    file_extension = path.split('.')[-1].lower()
+    if file_extension == 'csv':
+        return ','
+    elif file_extension == 'tsv':
+        return '\t'
+    elif file_extension in ['xls', 'xlsx']:
+        return None
+    raise ValueError("Unsupported file format!")
+
+
+def read_columns(path, header=True):
+    # Sniffs the column labels without reading the body of the file
+    sep = data_file_separator(path)
+    if sep is None:
+        return pd.read_excel(path, header=0 if header else None, nrows=1).columns.tolist()
+    return pd.read_csv(path, sep=sep, header=0 if header else None, nrows=1).columns.tolist()
+
+
+def _coerce_numeric(frame, numeric):
+    for column in numeric:
+        if frame[column].dtype != np.float64:
+            frame[column] = pd.to_numeric(frame[column], errors='coerce').astype(np.float64)
+    return frame
+
+
+REREAD = object()  # yielded by iter_data_chunks when every chunk before it must be discarded
+
+
+def iter_data_chunks(path, header=True, columns=None, numeric=()):
+    # Yields the selected columns of a data file in chunks, numeric columns as float64.
+    # Delimited files stream through pyarrow when it is installed, otherwise through pandas in chunks.
+    # If pyarrow fails partway, REREAD is yielded and the whole file follows again from pandas:
+    # rows and physical lines differ (quoted newlines, blank lines), so there is no safe resume point.
+    sep = data_file_separator(path)
+    if sep is None:
+        # Excel cannot be streamed, but only the selected columns are kept
+        yield _coerce_numeric(pd.read_excel(path, header=0 if header else None, usecols=columns), numeric)
+        return
+
+    try:
+        import pyarrow
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        pa_csv = None
+    if pa_csv is not None:
+        labels = read_columns(path, header)
+        names = [str(label) for label in labels]
+        selected = [str(column) for column in (columns if columns is not None else labels)]
+        read_options = pa_csv.ReadOptions(block_size=ARROW_BLOCK_BYTES, column_names=None if header else names)
+        convert_options = pa_csv.ConvertOptions(include_columns=selected,
+                                                column_types={str(column): pyarrow.float64() for column in numeric})
+        rename = dict(zip(names, labels))
+        yielded = False
+        try:
+            with pa_csv.open_csv(path, read_options=read_options, parse_options=pa_csv.ParseOptions(delimiter=sep),
+                                 convert_options=convert_options) as reader:
+                for batch in reader:
+                    yielded = True
+                    yield batch.to_pandas().rename(columns=rename)
+            return
+        except (pyarrow.ArrowInvalid, KeyError):
+            # Values pyarrow cannot type (e.g. stray text in a numeric column); pandas coerces them
+            if yielded:
+                yield REREAD
+
+    # Numeric columns are read as text and converted by _coerce_numeric, so stray values in them do not
+    # set off pandas' mixed-type guessing per block
+    dtype = {column: str for column in numeric}
+    for chunk in pd.read_csv(path, sep=sep, header=0 if header else None, usecols=columns, dtype=dtype,
+                             chunksize=CHUNK_ROWS):
+        yield _coerce_numeric(chunk, numeric)
+
+
+def read_data_file(path, header=True, columns=None, numeric=(), row_filter=None):
+    # row_filter(chunk) -> chunk is applied while streaming so dropped rows never accumulate
+    chunks = []
+    for chunk in iter_data_chunks(path, header, columns, numeric):
+        if chunk is REREAD:
+            chunks.clear()
+            continue
+        chunks.append(row_filter(chunk) if row_filter is not None else chunk)
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def point_row_filter(lat_column, lon_column, drop_outside=False):
+    # Drops rows without coordinates and, optionally, rows that fall outside the map
+    def keep(frame):
+        lon = frame[lon_column].to_numpy(dtype=float)
+        lat = frame[lat_column].to_numpy(dtype=float)
+        mask = np.isfinite(lon) & np.isfinite(lat)
+        if drop_outside:
+            xmin, ymin, xmax, ymax = projected_extent()
+            xyz = MAP_PROJECTION.transform_points(PLATE_CARREE, lon, lat)
+            mask &= (xyz[:, 0] >= xmin) & (xyz[:, 0] <= xmax) & (xyz[:, 1] >= ymin) & (xyz[:, 1] <= ymax)
+        return frame[mask]
+    return keep
+
+
+def plot_columns(settings):
+    # (columns, numeric columns) a render with these settings reads from the data file
+    if settings['plot_type'] == 'grid':
+        numeric = [settings['lat'], settings['lon']]
+        if settings['grid_statistic'] != 'count':
+            numeric.append(settings['grid_column'])
+        numeric = list(dict.fromkeys(numeric))
+        return numeric, numeric
+    if settings['plot_type'] == 'point':
+        numeric = [settings['lat'], settings['lon']]
+        if settings['size_column'] is not None:
+            numeric.append(settings['size_column'])
+        numeric = list(dict.fromkeys(numeric))
+        if settings['time_column'] is not None:
+            return list(dict.fromkeys([*numeric, settings['time_column']])), numeric
+        return numeric, numeric
+    if settings['frame_columns']:
+        numeric = list(dict.fromkeys(settings['frame_columns']))
+        return list(dict.fromkeys([settings['country_code'], *numeric])), numeric
+    return list(dict.fromkeys([settings['country_code'], settings['variable']])), []
+
+
+_plot_data_cache = {}  # single entry: file and row filter -> DataFrame of the columns loaded so far
+
+
+def load_plot_data(path, header, settings, preload=()):
+    # Reads only the columns the render needs; preload names extra columns to read in the same pass.
+    # Grid plots never hold the points: they are binned as the file streams in.
+    columns, numeric = plot_columns(settings)
+    point = settings['plot_type'] == 'point'
+    stat = os.stat(path)
+    if settings['plot_type'] == 'grid':
+        value_column = settings['grid_column'] if settings['grid_statistic'] != 'count' else None
+        key = (os.path.abspath(path), header, stat.st_size, stat.st_mtime_ns,
+               ('grid', settings['lat'], settings['lon'], value_column, settings['grid_size']))
+        cached = _plot_data_cache.get(key)
+        if cached is None:
+            with stage("Load and bin data file") as counts:
+                grid = ReferenceGrid(settings['grid_size'])
+                rows = 0
+                for chunk in iter_data_chunks(path, header, columns=columns, numeric=numeric):
+                    if chunk is REREAD:
+                        grid, rows = ReferenceGrid(settings['grid_size']), 0
+                        continue
+                    grid.add(chunk[settings['lon']].to_numpy(), chunk[settings['lat']].to_numpy(),
+                             chunk[value_column].to_numpy() if value_column is not None else None)
+                    rows += len(chunk)
+                grid.merge_pending()
+                counts['rows'] = rows
+                counts['bytes'] = stat.st_size
+                counts['cells'] = lambda: int(np.count_nonzero(grid.counts))
+            _plot_data_cache.clear()
+            _plot_data_cache[key] = grid
+            return grid
+        return cached
+    row_key = (settings['lat'], settings['lon'], settings['drop_outside']) if point else None
+    key = (os.path.abspath(path), header, stat.st_size, stat.st_mtime_ns, row_key)
+    cached = _plot_data_cache.get(key)
+    if cached is not None and set(columns) <= set(cached.columns):
+        return cached
+
+    # Keep what was loaded before so switching back and forth between columns does not reread
+    if cached is not None:
+        columns = list(dict.fromkeys([*cached.columns, *columns]))
+    columns = list(dict.fromkeys([*columns, *preload]))
+    if point:
+        numeric = [column for column in columns if column != settings['time_column']]  # times stay as read
+    row_filter = point_row_filter(settings['lat'], settings['lon'], settings['drop_outside']) if point else None
+    with stage("Load data file") as counts:
+        data = read_data_file(path, header, columns=columns, numeric=numeric, row_filter=row_filter)
+        counts['rows'] = len(data)
+        counts['columns'] = len(columns)
+        counts['bytes'] = stat.st_size
+    _plot_data_cache.clear()
+    _plot_data_cache[key] = data
+    return data
+
+
+def clear_caches():
+    # Forget every in-memory cache, as on a fresh start; the on-disk boundary cache is kept
+    for cache in (_boundary_cache, _geometry_lods, _coastline_layers, _point_counts_cache, _plot_data_cache,
+                  _data_positions):
+        cache.clear()
+
+
+EXPORT_FORMATS = ('svg', 'svgz', 'pdf', 'png')
+DENSE_LAYER_MARKERS = 10_000  # a data layer with more dots than this is rasterized in vector exports
+DENSE_LAYER_VERTICES = 1_000_000  # likewise for polygons and lines
+SVG_DECIMALS = 1  # decimals kept in SVG coordinates, which are in points: a tenth of a point is 0.035 mm
+
+
+def layer_size(artists):
+    # (markers, vertices) a layer puts into a vector file
+    markers = vertices = 0
+    for artist in artists:
+        if isinstance(artist, Collection) and len(artist.get_offsets()) > 1:
+            markers += len(artist.get_offsets())
+        elif isinstance(artist, Collection):
+            vertices += sum(len(path.vertices) for path in artist.get_paths())
+    return markers, vertices
+
+
+def rasterize_dense_layers(map_figure, rasterize='auto'):
+    # 'auto' embeds the data layer as an image when it is too dense to be useful as vectors,
+    # 'data' always does, 'none' never does; boundaries and coastlines stay vector either way
+    markers, vertices = layer_size(map_figure.layers['data'])
+    if rasterize == 'data' or (rasterize == 'auto' and (markers > DENSE_LAYER_MARKERS or vertices > DENSE_LAYER_VERTICES)):
+        for artist in map_figure.layers['data']:
+            artist.set_rasterized(True)
+        return True
+    return False
+
+
+def estimate_export_size(map_figure, file_format, decimals=SVG_DECIMALS, dpi=EXPORT_DPI):
+    # Rough size in bytes of what savefig will write, from the marker, vertex and raster pixel counts
+    width, height = map_figure.figure.get_size_inches() * dpi
+    if file_format == 'png':
+        return int(width * height * 0.05)
+    raster = [artist for artist in map_figure.ax.get_children() if artist.get_rasterized() or isinstance(artist, AxesImage)]
+    vector = [artist for layer in map_figure.layers.values() for artist in layer if artist not in raster]
+    markers, vertices = layer_size(vector)
+    digits = 6 if decimals is None else decimals
+    size = markers * (60 + 2 * digits) + vertices * (13 + 2 * digits) + (width * height * 0.005 if raster else 0)
+    if file_format == 'svgz':
+        size *= 0.25
+    elif file_format == 'pdf':
+        size *= 0.6  # content streams are deflated
+    return int(size + 20_000)
+
+
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024 or unit == 'MB':
+            return f"{size:.0f} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class RoundingSVGWriter:
+    # Text stream handed to the SVG backend that rounds path and marker coordinates to decimals places.
+    # Output is held back to the end of the last complete tag, so an attribute split across writes is
+    # still rounded whole; finish() writes the rest. Rounding each number in Python makes saving about a
+    # third slower than cutting digits did, which biased every coordinate by half a unit.
+    coordinates = re.compile(r'( [dxy]=")([^"]*)')
+
+    def __init__(self, stream, decimals):
+        self.stream = stream
+        self.pending = ''
+        number = re.compile(r'-?\d+\.\d{%d,}' % (decimals + 1))  # only numbers with digits to drop
+        rounded = lambda match: '%.*f' % (decimals, float(match[0]))
+        self.rounder = lambda match: match[1] + number.sub(rounded, match[2])
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)  # seek, flush and the rest come from the wrapped file
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError("RoundingSVGWriter is a text stream")  # tells matplotlib not to write bytes
+        self.pending += text
+        end = self.pending.rfind('>') + 1
+        if end:
+            self.stream.write(self.coordinates.sub(self.rounder, self.pending[:end]))
+            self.pending = self.pending[end:]
+        return len(text)
+
+    def finish(self):
+        self.stream.write(self.coordinates.sub(self.rounder, self.pending))
+        self.pending = ''
+
+
+def write_figure(figure, path, file_format, decimals=SVG_DECIMALS):
+    # Streams the figure to path; SVG and SVGZ coordinates are rounded to decimals places unless None
+    if file_format in ('svg', 'svgz'):
+        opener = (lambda: gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)) if file_format == 'svgz' \
+            else (lambda: open(path, 'w', encoding='utf-8'))
+        with opener() as f:
+            if decimals is None:
+                figure.savefig(f, format='svg', dpi=EXPORT_DPI)
+            else:
+                writer = RoundingSVGWriter(f, decimals)
+                figure.savefig(writer, format='svg', dpi=EXPORT_DPI)
+                writer.finish()
+    else:
+        figure.savefig(path, format=file_format, dpi=EXPORT_DPI)
+
+
+def export_map(geo_data, data, settings, file_path, step=None, rasterize='auto', decimals=SVG_DECIMALS):
+    # The 20x20 inch export shared by Save to Disk and the batch renderer; format follows the extension
+    step = step or (lambda message: None)
+    file_format = os.path.splitext(file_path)[1][1:].lower() or 'svg'
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {file_format}")
+    # Scale the dot size to match the figure size ratio
+    scale_factor = 20 / 10  # High-res figure size / low-res figure size
+    map_figure = build_figure(geo_data, data, settings, figsize=(20, 20), scale_factor=scale_factor,
+                              coastline_resolution='10m', dpi=EXPORT_DPI, step=step)
+    rasterized = file_format != 'png' and rasterize_dense_layers(map_figure, rasterize)
+    estimate = estimate_export_size(map_figure, file_format, decimals)
+    step(f"Writing file (about {format_size(estimate)})")
+    # Write next to the target and only replace it if the export was not cancelled
+    partial_path = file_path + '.part'
+    try:
+        with stage("Save figure") as counts:
+            write_figure(map_figure.figure, partial_path, file_format, decimals)
+            counts['format'] = file_format
+            counts['rasterized'] = rasterized
+            counts['estimate'] = estimate
+            counts['bytes'] = os.path.getsize(partial_path)
+        step("Finishing")
+        os.replace(partial_path, file_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return file_path
+
+
+ANIMATION_FORMATS = ('gif', 'mp4', 'svg')  # svg writes one numbered file per frame
+ANIMATION_FIGSIZE = (8, 8)  # inches at ANIMATION_DPI: 800x800 pixel GIF and MP4 frames
+ANIMATION_DPI = 100
+FRAMES_PER_TASK = 4  # frames a pool worker renders between progress updates
+
+
+def animation_figure(geo_data, data, settings, file_format):
+    # SVG frames are full-size exports, raster frames are drawn at the animation size
+    if file_format == 'svg':
+        map_figure = build_figure(geo_data, data, settings, figsize=(20, 20), scale_factor=20 / 10,
+                                  coastline_resolution='10m', dpi=EXPORT_DPI)
+        rasterize_dense_layers(map_figure)
+        return map_figure
+    map_figure = build_figure(geo_data, data, settings, figsize=ANIMATION_FIGSIZE, scale_factor=ANIMATION_FIGSIZE[0] / 10,
+                              dpi=ANIMATION_DPI)
+    map_figure.figure.set_dpi(ANIMATION_DPI)
+    return map_figure
+
+
+class FrameRenderer:
+    # Renders frames of one built map. Raster frames are blitted: everything below the data
+    # layer is drawn once, then each frame restores that bitmap and draws only the data layer
+    # and what lies on top of it. SVG frames are complete files.
+    def __init__(self, map_figure, file_format):
+        self.map_figure = map_figure
+        self.file_format = file_format
+        self.canvas = None
+        self.background = None
+        self.artists = map_figure.restyled_artists()
+
+    def render(self, indexes, pattern):
+        figure = self.map_figure.figure
+        for index in indexes:
+            self.map_figure.show_frame(index)
+            if self.file_format == 'svg':
+                write_figure(figure, pattern % index, 'svg')
+                continue
+            if self.background is None:
+                self.canvas = FigureCanvasAgg(figure)
+                for artist in self.artists:
+                    artist.set_animated(True)  # left out of the background
+                self.canvas.draw()
+                self.background = self.canvas.copy_from_bbox(figure.bbox)
+            self.canvas.restore_region(self.background)
+            for artist in self.artists:
+                figure.draw_artist(artist)
+            Image.fromarray(np.asarray(self.canvas.buffer_rgba())).convert('RGB').save(pattern % index, compress_level=1)  # scratch file
+        return len(indexes)
+
+
+_frame_worker = {}  # pool worker state: the map's inputs, then its FrameRenderer once built
+
+
+def init_frame_worker(geo_data, data, settings, file_format):
+    _frame_worker.clear()
+    _frame_worker['inputs'] = (geo_data, data, settings, file_format)
+
+
+def render_frames(indexes, pattern):
+    # Pool task; the first task a worker runs builds the map, so build errors reach the caller
+    if 'renderer' not in _frame_worker:
+        geo_data, data, settings, file_format = _frame_worker['inputs']
+        _frame_worker['renderer'] = FrameRenderer(animation_figure(geo_data, data, settings, file_format), file_format)
+    return _frame_worker['renderer'].render(indexes, pattern)
+
+
+def animation_frame_count(data, settings):
+    if settings['plot_type'] == 'choropleth' and settings['frame_columns']:
+        return len(settings['frame_columns'])
+    if settings['plot_type'] == 'point' and settings['time_column'] is not None:
+        return int(data[settings['time_column']].nunique())
+    raise ValueError("An animation needs frame columns (choropleth) or a time column (point plot)")
+
+
+def export_animation(geo_data, data, settings, file_path, step=None, workers=None, fps=2):
+    # Frames are rendered across a process pool, each worker building the map once. GIF frames
+    # are assembled with Pillow, MP4 with the local ffmpeg; SVG frames are written next to
+    # file_path as stem_0000.svg, stem_0001.svg, ... Returns what was written.
+    step = step or (lambda message: None)
+    stem, extension = os.path.splitext(file_path)
+    file_format = extension[1:].lower()
+    if file_format not in ANIMATION_FORMATS:
+        raise ValueError(f"Unsupported animation format: {file_format}")
+    encoder = None
+    if file_format == 'mp4':
+        encoder = shutil.which(rcParams['animation.ffmpeg_path'])
+        if encoder is None:
+            raise RuntimeError("MP4 export needs ffmpeg; install it or save the animation as GIF")
+    frame_count = animation_frame_count(data, settings)
+    if not 0 < frame_count <= MAX_FRAMES:
+        raise ValueError(f"{frame_count} frames, an animation needs 1 to {MAX_FRAMES}")
+    tasks = [list(range(start, min(start + FRAMES_PER_TASK, frame_count))) for start in range(0, frame_count, FRAMES_PER_TASK)]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+
+    # Frames go to a scratch directory next to the target and are only moved or encoded once all are done
+    with tempfile.TemporaryDirectory(prefix='.frames-', dir=os.path.dirname(os.path.abspath(file_path))) as scratch:
+        pattern = os.path.join(scratch, 'frame_%04d.svg' if file_format == 'svg' else 'frame_%04d.png')
+        with stage("Render frames") as counts:
+            done = 0
+            step(f"Rendering frames (0/{frame_count})")
+            if workers == 1:
+                renderer = FrameRenderer(animation_figure(geo_data, data, settings, file_format), file_format)
+                for task in tasks:
+                    done += renderer.render(task, pattern)
+                    step(f"Rendering frames ({done}/{frame_count})")
+            else:
+                # Spawned, not forked: the caller may be a GUI with threads running
+                pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=init_frame_worker, initargs=(geo_data, data, settings, file_format))
+                try:
+                    for future in as_completed([pool.submit(render_frames, task, pattern) for task in tasks]):
+                        done += future.result()
+                        step(f"Rendering frames ({done}/{frame_count})")
+                finally:
+                    pool.shutdown(cancel_futures=True)
+            counts['frames'] = frame_count
+            counts['workers'] = workers
+            counts['format'] = file_format
+
+        step("Encoding animation")
+        with stage("Encode animation") as counts:
+            if file_format == 'svg':
+                for index in range(frame_count):
+                    os.replace(pattern % index, f"{stem}_{index:04d}.svg")
+                written = f"{stem}_{0:04d}.svg ... {stem}_{frame_count - 1:04d}.svg"
+                counts['bytes'] = sum(os.path.getsize(f"{stem}_{index:04d}.svg") for index in range(frame_count))
+            else:
+                partial_path = os.path.join(scratch, 'animation.' + file_format)
+                if file_format == 'gif':
+                    first = Image.open(pattern % 0)
+                    first.save(partial_path, format='GIF', save_all=True, loop=0, duration=round(1000 / fps),
+                               append_images=(Image.open(pattern % index) for index in range(1, frame_count)))
+                else:
+                    # yuv420p plays everywhere but needs even frame sizes
+                    result = subprocess.run([encoder, '-y', '-loglevel', 'error', '-framerate', str(fps), '-i', pattern,
+                                             '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', '-f', 'mp4', partial_path],
+                                            capture_output=True, text=True)
+                    if result.returncode != 0:
+                        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
+                counts['bytes'] = os.path.getsize(partial_path)
+                os.replace(partial_path, file_path)
+                written = file_path
+    return written
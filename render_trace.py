@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+import contextlib
+
+# Per-stage timings, row/vertex counts and, on request, peak allocated memory of one render, shared
+# by the GUI and the batch renderer. A RenderTrace is activated for the current thread with "with trace:"; code in
+# map_render marks its stages with "with stage(name) as counts:" and those are no-ops when no
+# trace is active.
+
+
+def trace_dir():
+    # Where traces and profiles go unless a path is given
+    if os.environ.get('GEOPLOT_TRACE_DIR'):
+        return os.environ['GEOPLOT_TRACE_DIR']
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'geospatial_data_plotter', 'traces')
+
+
+def process_peak_rss():
+    # Peak resident memory of this process over its whole lifetime in bytes, None where it cannot be read
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, KiB elsewhere
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (ImportError, OSError, AttributeError):
+        pass
+    return None
+
+
+_active = threading.local()
+
+# Stage memory comes from tracemalloc, which runs while a trace that tracks memory is open. Its peak is process-wide
+# and can only be reset globally, so every reset first folds the peak into all open measurements,
+# including those of nested stages and of traces on other threads.
+_memory_lock = threading.Lock()
+_memory_users = 0
+_memory_owner = False  # whether tracing was started here, rather than by -X tracemalloc
+_open_marks = []  # [traced bytes at start, peak traced bytes since] of each open stage and trace
+
+
+def _fold_peak():
+    peak = tracemalloc.get_traced_memory()[1]
+    for mark in _open_marks:
+        mark[1] = max(mark[1], peak)
+    tracemalloc.reset_peak()
+
+
+def start_memory_tracking():
+    global _memory_users, _memory_owner
+    with _memory_lock:
+        if _memory_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _memory_owner = True
+        _memory_users += 1
+
+
+def stop_memory_tracking():
+    global _memory_users, _memory_owner
+    with _memory_lock:
+        _memory_users -= 1
+        if _memory_users == 0 and _memory_owner:
+            tracemalloc.stop()
+            _memory_owner = False
+
+
+def memory_mark():
+    # Starts measuring the peak memory allocated from now on
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            return None
+        _fold_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        mark = [current, current]
+        _open_marks.append(mark)
+        return mark
+
+
+def memory_peak(mark):
+    # Peak bytes allocated above the level at memory_mark(), None if memory was not tracked
+    if mark is None:
+        return None
+    with _memory_lock:
+        _fold_peak()
+        _open_marks[:] = [other for other in _open_marks if other is not mark]
+        return mark[1] - mark[0]
+
+
+def current_trace():
+    return getattr(_active, 'trace', None)
+
+
+class RenderTrace:
+    # Stages in the order they ran: {'stage', 'seconds', 'peak_memory', **counts}. With track_memory,
+    # peak_memory is the most Python and numpy memory the stage had allocated at once; allocations made
+    # by other threads meanwhile are counted too, and those inside GEOS or the Agg renderer are not.
+    # Tracking slows allocation-heavy stages such as drawing and saving by up to a few times, so it is
+    # off by default and peak_memory is None.
+    # path writes the trace as JSON when the render finishes, profile_path captures it with cProfile.
+    def __init__(self, label, path=None, profile_path=None, track_memory=False, **info):
+        self.label = label
+        self.track_memory = track_memory
+        self.info = info
+        self.path = path
+        self.profile_path = profile_path
+        self.stages = []
+        self.seconds = None
+        self.error = None
+        self.profiler = None
+        self.previous = None
+        self.started = None
+        self.memory = None
+        self.memory_mark = None
+
+    def __enter__(self):
+        self.previous = current_trace()
+        _active.trace = self
+        if self.profile_path:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self.track_memory:
+            start_memory_tracking()
+            self.memory_mark = memory_mark()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        self.seconds = time.perf_counter() - self.started
+        if self.track_memory:
+            self.memory = memory_peak(self.memory_mark)
+            stop_memory_tracking()
+        _active.trace = self.previous
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(os.path.dirname(self.profile_path) or '.', exist_ok=True)
+            self.profiler.dump_stats(self.profile_path)
+            self.profiler = None
+        if error is not None:
+            self.error = repr(error)
+        if self.path:
+            try:
+                self.write(self.path)
+            except OSError as e:
+                print(f"Could not write render trace: {e}")
+        return False
+
+    def record(self, name, seconds, memory, counts):
+        # Counts may be callables so expensive ones are only computed while tracing
+        counts = {key: value() if callable(value) else value for key, value in counts.items()}
+        self.stages.append({'stage': name, 'seconds': round(seconds, 6), 'peak_memory': memory, **counts})
+
+    def summary(self, slowest=3):
+        # One line for a status bar: the slowest stages, the total and the memory peak of the render,
+        # or of the process so far when the render's own is not tracked
+        stages = sorted(self.stages, key=lambda stage: stage['seconds'], reverse=True)[:slowest]
+        parts = [f"{stage['stage']} {stage['seconds']:.2f}s" for stage in stages]
+        total = self.seconds if self.seconds is not None else sum(stage['seconds'] for stage in self.stages)
+        line = f"{total:.2f}s total"
+        if parts:
+            line += f" ({', '.join(parts)})"
+        if self.memory is not None:
+            line += f", peak {self.memory / 2 ** 20:.0f} MB allocated"
+        elif (peak := process_peak_rss()) is not None:
+            line += f", process peak {peak / 2 ** 20:.0f} MB"
+        return line
+
+    def to_dict(self):
+        return {'label': self.label, **self.info, 'seconds': self.seconds, 'error': self.error,
+                'peak_memory': self.memory, 'process_peak_rss': process_peak_rss(), 'profile': self.profile_path,
+                'stages': self.stages}
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return path
+
+
+@contextlib.contextmanager
+def stage(name, **counts):
+    # Times the block into the active trace; counts added to the yielded dict are recorded with it
+    trace = current_trace()
+    if trace is None:
+        yield counts
+        return
+    mark = memory_mark() if trace.track_memory else None
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        seconds = time.perf_counter() - start
+        trace.record(name, seconds, memory_peak(mark), counts)